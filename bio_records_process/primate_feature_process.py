@@ -37,15 +37,18 @@ class primate_feature_process():
     
     
     def calculation_1st_stats_perm(self, _1st_stats, _1st_stats_temporal, num_perm=1000, seed=666, **kwargs):
+        """
+            return lazy Permuted_Stats of (1000, 50, 50) and (1000, 26, 50, 50), only the (num_perm, num_samples) indices 
+            are stored, the permuted matrices are identical to the legacy materialized arrays
+        """
         
         num_samples = _1st_stats.shape[0]
-        num_steps = _1st_stats_temporal.shape[0]
         
         np.random.seed(seed)     # re-initialize to make the permutation constant
-        perm_indces = [np.random.permutation(num_samples) for _ in range(num_perm)]
+        perm_indces = np.array([np.random.permutation(num_samples) for _ in range(num_perm)])     # (1000, 50)
         
-        _1st_stats_perm = np.array([_1st_stats[np.ix_(_, _)] for _ in perm_indces])     # (1000, 50, 50)
-        _1st_stats_temporal_perm = np.array([np.array([_1st_stats_temporal[t][np.ix_(_, _)] for t in range(num_steps)]) for _ in perm_indces])     # (1000, 26, 50, 50)
+        _1st_stats_perm = Permuted_Stats(_1st_stats, perm_indces)     # (1000, 50, 50)
+        _1st_stats_temporal_perm = Permuted_Stats(_1st_stats_temporal, perm_indces)     # (1000, 26, 50, 50)
 
         return _1st_stats_perm, _1st_stats_temporal_perm
     
@@ -83,4 +86,73 @@ def _calculation_Gram(feature, kernel='linear', **kwargs):
     else:
         raise ValueError
     
-    return gram(feature, **kwargs)
\ No newline at end of file
+    return gram(feature, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class Permuted_Stats():
+    """
+        lazy permutations of a (n, n) or (time_steps, n, n) 1st-order statistic, only the (num_perm, n) indices are stored
+        
+        self[i] == stats[..., perm_indices[i][:, None], perm_indices[i][None, :]], iteration and np.array(self) behave as 
+        the legacy materialized (num_perm, (time_steps,) n, n) array, self.vectorize() gathers the permuted upper triangles 
+        without building any permuted matrix
+    """
+    
+    def __init__(self, stats, perm_indices, **kwargs):
+        
+        assert stats.shape[-1] == stats.shape[-2] == perm_indices.shape[-1]
+        
+        self.stats = stats
+        self.perm_indices = perm_indices
+        
+    
+    @property
+    def shape(self):
+        return (self.perm_indices.shape[0], *self.stats.shape)
+    
+    @property
+    def ndim(self):
+        return self.stats.ndim + 1
+    
+    @property
+    def dtype(self):
+        return self.stats.dtype
+    
+    def __len__(self):
+        return self.perm_indices.shape[0]
+    
+    
+    def __getitem__(self, idx):
+        
+        if isinstance(idx, (int, np.integer)):
+            p = self.perm_indices[idx]
+            return self.stats[..., p[:, None], p[None, :]]
+        
+        return Permuted_Stats(self.stats, self.perm_indices[idx])
+    
+    
+    def __iter__(self):
+        
+        for idx in range(len(self)):
+            yield self[idx]
+            
+    
+    def __array__(self, dtype=None, copy=None):
+        
+        perm = np.array([_ for _ in self]).reshape(self.shape)
+        
+        return perm if dtype is None else perm.astype(dtype)
+    
+    
+    def vectorize(self, k=1) -> np.ndarray:
+        """ (num_perm, (time_steps,) n*(n-1)/2), the same as utils_similarity.RSM_vectorize() of every permuted matrix """
+        
+        rows, cols = np.triu_indices(self.stats.shape[-1], k)
+        
+        P_rows, P_cols = self.perm_indices[:, rows], self.perm_indices[:, cols]     # (num_perm, n*(n-1)/2)
+        
+        if self.stats.ndim == 2:
+            return self.stats[P_rows, P_cols]
+        else:
+            return np.moveaxis(self.stats[:, P_rows, P_cols], 0, 1)     # (num_perm, time_steps, n*(n-1)/2)
@@ -7,6 +7,9 @@ Created on Fri Apr 14 20:10:50 2023
 
     - hook based feature extraction
     - usage: python extract_by_hook.py <universal args> NN <NN extracting args>
+    - batch: python extract_by_hook.py <universal args> --manifest jobs.json [--max_jobs 2 --memory_budget 16]
+      jobs.json: [{"command": "SNN", "model": "spiking_vgg16_bn", "model_weight": "...", "FSA_config": "...", ...}, ...]
+      every job overrides the universal args and the defaults of its NN args
     
     *** this script only provided 'model_name' as entrance, not any model
     *** check legacy code for forward-based feature extraction
@@ -16,12 +19,17 @@ Created on Fri Apr 14 20:10:50 2023
 # --- python
 import os
 import sys
+import json
 import argparse
+import threading
+import traceback
 from tqdm import tqdm
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 # --- pytorch
 import torch
+import numpy as np
 
 # --- spikingjelly
 from spikingjelly.activation_based import neuron, functional
@@ -45,8 +53,14 @@ def universal_extracting_parser(parser):
     parser.add_argument("--hierarchy", type=str, default='cls')
     parser.add_argument("--split_ratio", type=float, default=0.)
     
-    # --- dummy inference
+    # --- dummy inference, features of every batch are written in place into the preallocated per-layer arrays
     parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--extract_mmap", action='store_true', help="write the features through to the memory-mapped feature store instead of RAM")
+    
+    # --- batch extraction, see Extraction_Runner
+    parser.add_argument("--manifest", type=str, default=None, help="json list of jobs, each overrides the args")
+    parser.add_argument("--max_jobs", type=int, default=1, help="number of concurrent jobs")
+    parser.add_argument("--memory_budget", type=float, default=None, help="GB of in-RAM features of concurrent jobs")
     
     return parser
     
@@ -71,7 +85,9 @@ def SNN_extracting_parser(parser_SNN, _neuron='LIF', _surrogate='ATan', T=4):
     parser_SNN.add_argument('--surrogate', type=str, default=f'{_surrogate}')
     parser_SNN.add_argument("--T", type=int, default=T)
     
-    parser_SNN.add_argument("--return_firing_rate", default=True)
+    parser_SNN.add_argument("--return_firing_rate", type=lambda x: str(x).lower() in ['true', '1'], default=True, help="False: save the full spike trains as bit-packed spike store")
+    parser_SNN.add_argument("--spike_counts", type=lambda x: str(x).lower() in ['true', '1'], default=True, help="save the firing rates losslessly as uint8 spike counts, T is recorded in the metadata, float32 firing rates if T >= 256")
+    parser_SNN.add_argument("--cumulative_counts", action='store_true', help="also save the (T, num_samples, num_units) cumulative spike counts for time window firing rates")
     
     return parser_SNN
 
@@ -102,7 +118,37 @@ def extracting_script_parser():
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-class SP_Extractor_ANN(SP_Trainer_ANN):
+class Shared_Resources_Mixin():
+    """
+        datasets: (dataset_train, dataset_val) already prepared, skip the dataset setup
+        model: a built architecture to reuse, the weights are overwritten by load_weight()
+    """
+    
+    def __init__(self, args, datasets=None, model=None, **kwargs) -> None:
+        
+        self._shared_datasets = datasets
+        self._shared_model = model
+        
+        super().__init__(args, **kwargs)
+    
+    
+    def prepare_datasets(self, args, verbose=False, **kwargs):
+        
+        if self._shared_datasets is not None:
+            self.dataset_train, self.dataset_val = self._shared_datasets
+        else:
+            super().prepare_datasets(args, verbose=verbose, **kwargs)
+    
+    
+    def load_model(self, args):
+        
+        if self._shared_model is not None:
+            self.model = self._shared_model
+        else:
+            super().load_model(args)
+    
+
+class SP_Extractor_ANN(Shared_Resources_Mixin, SP_Trainer_ANN):
     
     def __init__(self, args, **kwargs) -> None:
         
@@ -116,16 +162,21 @@ class SP_Extractor_ANN(SP_Trainer_ANN):
         self.load_weight(model_weight)
         
 
-    def extract(self, args, **kwargs):
-
-        layers_info_generator = get_layers_info_generator_ANN(args, **kwargs)
+    def extract(self, args, layers_info=None, **kwargs):
+        """ layers_info: (layers, units, shapes) already probed for this architecture """
+        
+        if layers_info is None:
+            layers_info = get_layers_info(get_layers_info_generator_ANN(args, **kwargs), 'an')
 
-        self.layers, self.units, self.shapes = get_layers_info(layers_info_generator, 'an')
+        self.layers, self.units, self.shapes = layers_info
+        
+        self.save_path = get_features_path(args)
         
         # --- obtains the feature map
+        self.features = allocate_features(self.layers, self.units, len(self.data_loader_val.dataset), save_path=self.save_path if args.extract_mmap else None)
+        
         self.hook_registration()
         self.evaluate(args)     
-        self.features_transformation()
         
         self.features_check()
         
@@ -136,28 +187,25 @@ class SP_Extractor_ANN(SP_Trainer_ANN):
         
         for idx, u in enumerate(self.units):
             
-            assert self.features[idx].shape[1] == u, 'Detected abnormal shape, please check transform() of dataset'
+            assert self.features[idx].shape[-1] == u, 'Detected abnormal shape, please check transform() of dataset'
     
     
     def features_save(self, args) -> None:
         
-        self.save_path = os.path.join(args.FSA_root, args.FSA_dir, f'FSA {args.FSA_config}/Features')
-        
-        os.makedirs(self.save_path, exist_ok=True)
-        
-        for idx, _layer in tqdm(enumerate(self.layers), 'Saving Feature', total=len(self.layers)):
-            
-            utils_.dump(self.features[idx], os.path.join(self.save_path, f'{_layer}.pkl'), verbose=False)
+        save_features(self.features, self.layers, self.save_path, num_classes=args.num_classes)
             
     
     def hook_fn(self, module, inputs, outputs) -> None:
+        """ the hooks fire in forward order, a module called twice (e.g. relu of resnet block) fills 2 layers """
+        
+        output = outputs.detach().reshape(outputs.shape[0], -1)     # (batch_size, num_units)
         
-        self.feature_single_layer.append(outputs.detach().cpu().reshape(args.batch_size, -1))
+        self.features[self.layer_idx][self.offset:self.offset+output.shape[0]] = output.cpu().numpy()
+        self.layer_idx += 1
     
 
     def hook_registration(self, ) -> None:
 
-        self.feature_single_layer = []
         self.handles = []
         
         for _, _m in self.model.named_modules():
@@ -165,12 +213,6 @@ class SP_Extractor_ANN(SP_Trainer_ANN):
                 handle = _m.register_forward_hook(self.hook_fn)
                 self.handles.append(handle)
 
-    
-    def features_transformation(self, ) -> None:
-
-        num_layers = len(self.features[0])
-        self.features = [torch.stack([self.features[i_idx][l_idx] for i_idx in range(500)], dim=0).reshape(500, -1).numpy() for l_idx in tqdm(range(num_layers), desc='Transforming')]
-             
 
     def evaluate(self, args, verbose=True) -> None:
 
@@ -184,39 +226,47 @@ class SP_Extractor_ANN(SP_Trainer_ANN):
         
         with torch.inference_mode():
             
-            self.features = []
+            try:
+                
+                self.offset = 0     # sample offset of the current batch, the val sampler is sequential
             
-            for i, (image, target) in tqdm(enumerate(self.data_loader_val), desc='Extracting', total=len(self.data_loader_val)):
+                for i, (image, target) in tqdm(enumerate(self.data_loader_val), desc='Extracting', total=len(self.data_loader_val)):
+                
+                    image = image.to(self.device, non_blocking=True)
+                    target = target.to(self.device, non_blocking=True)
+                    image = self.preprocess_test_sample(args, image)
                 
-                image = image.to(self.device, non_blocking=True)
-                target = target.to(self.device, non_blocking=True)
-                image = self.preprocess_test_sample(args, image)
+                    self.layer_idx = 0
 
-                output = self.process_model_output(args, self.model(image))
-                loss = self.criterion(output, target)
+                    output = self.process_model_output(args, self.model(image))
+                    loss = self.criterion(output, target)
 
-                acc1, acc5 = self.cal_acc1_acc5(output, target)
-                batch_size = target.shape[0]
+                    acc1, acc5 = self.cal_acc1_acc5(output, target)
+                    batch_size = target.shape[0]
 
-                functional.reset_net(self.model)
+                    functional.reset_net(self.model)
                 
-                top1.update(acc1.item(), batch_size)
-                top5.update(acc5.item(), batch_size)
-                _loss.update(loss.item(), batch_size)
+                    top1.update(acc1.item(), batch_size)
+                    top5.update(acc5.item(), batch_size)
+                    _loss.update(loss.item(), batch_size)
                 
-                # --- features
-                self.features.append(self.feature_single_layer)
-                self.feature_single_layer = []
+                    # --- features
+                    assert self.layer_idx == len(self.features), f'[Coderror] {self.layer_idx} hooked outputs for {len(self.features)} layers'
+                    self.offset += batch_size
+            
+                assert self.offset == self.features[0].shape[-2], f'[Coderror] {self.offset} extracted samples for {self.features[0].shape[-2]} allocated'
             
-            for handle in self.handles:
-                handle.remove()
+            finally:     # --- also on failure, the model may be reused by another extractor
+                
+                for handle in self.handles:
+                    handle.remove()
 
         if verbose:
             print(f'Validation -> acc@1: {top1.avg:.3f}, acc@5: {top5.avg:.3f}, loss: {_loss.avg:.5f}')
             
 
 # ----------------------------------------------------------------------------------------------------------------------
-class SP_Extractor_SNN(SP_Trainer_SNN):
+class SP_Extractor_SNN(Shared_Resources_Mixin, SP_Trainer_SNN):
 
     def __init__(self, args, **kwargs) -> None:
         
@@ -230,18 +280,29 @@ class SP_Extractor_SNN(SP_Trainer_SNN):
         self.load_weight(model_weight)
         
 
-    def extract(self, args, **kwargs):
-
-        layers_info_generator = get_layers_info_generator_SNN(args, **kwargs)
+    def extract(self, args, layers_info=None, **kwargs):
+        """ layers_info: (layers, units, shapes) already probed for this architecture """
+        
+        if layers_info is None:
+            layers_info = get_layers_info(get_layers_info_generator_SNN(args, **kwargs), 'sn')
 
-        self.layers, self.units, self.shapes = get_layers_info(layers_info_generator, 'sn')
+        self.layers, self.units, self.shapes = layers_info
         
         target_module = neuron.__dict__[f'{args.neuron}Node']
 
-        # --- obtains the feature map
-        self.hook_registration(target_module=target_module)
+        self.save_path = get_features_path(args)
+        
+        # --- obtains the feature map, the full spike trains are written batch by batch to the spike store
+        if args.return_firing_rate:
+            self.features = allocate_features(self.layers, self.units, len(self.data_loader_val.dataset), save_path=self.save_path if args.extract_mmap else None, dtype=np.uint8 if use_spike_counts(args) else np.float32)
+        else:
+            self.features = [utils_.Spike_Store_Writer(os.path.join(self.save_path, f'{layer}'), T=args.T, num_units=u) for layer, u in zip(self.layers, self.units)]
+        
+        # --- cumulative spike counts over t=1..T, the firing rates of any time window without spike trains
+        self.cumulative_counts = [utils_.open_cumulative_counts(os.path.join(self.save_path, f'{layer}'), args.T, len(self.data_loader_val.dataset), u) for layer, u in zip(self.layers, self.units)] if args.cumulative_counts else None
+        
+        self.hook_registration(target_module=target_module, return_firing_rate=args.return_firing_rate)
         self.evaluate(args)     
-        self.features_transformation()
         
         self.features_check()
         
@@ -252,59 +313,51 @@ class SP_Extractor_SNN(SP_Trainer_SNN):
         
         for idx, u in enumerate(self.units):
             
-            assert self.features[idx].shape[1] == u, 'Detected abnormal shape, please check transform() of dataset'
+            assert self.features[idx].shape[-1] == u, 'Detected abnormal shape, please check transform() of dataset'
     
     
     def features_save(self, args) -> None:
         
-        self.save_path = os.path.join(args.FSA_root, args.FSA_dir, f'FSA {args.FSA_config}/Features')
+        spike_counts = {'encoding': 'spike_count', 'T': args.T} if args.return_firing_rate and use_spike_counts(args) else {}
         
-        os.makedirs(self.save_path, exist_ok=True)
+        save_features(self.features, self.layers, self.save_path, num_classes=args.num_classes, **spike_counts)
         
-        for idx, _layer in tqdm(enumerate(self.layers), 'Saving Feature', total=len(self.layers)):
-            
-            utils_.dump(self.features[idx], os.path.join(self.save_path, f'{_layer}.pkl'), verbose=False)
+        if self.cumulative_counts is not None:
+            for cumulative_counts in self.cumulative_counts:
+                cumulative_counts.flush()
             
 
     def hook_fn(self, module, inputs, outputs, return_firing_rate=True) -> None:
+        """ outputs: (T, batch_size, ...) of the multi-step neuron """
+        
+        outputs = outputs.detach()
+        
+        if self.cumulative_counts is not None:
+            self.cumulative_counts[self.layer_idx][:, self.offset:self.offset+outputs.shape[1]] = torch.cumsum(outputs.reshape(outputs.shape[0], outputs.shape[1], -1), dim=0).to(torch.uint8).cpu().numpy()
         
-        if return_firing_rate:
-            self.feature_single_layer.append(torch.mean(outputs.detach().cpu(), dim=0)) 
+        if return_firing_rate and self.features[self.layer_idx].dtype == np.uint8:     # exact spike counts k of the firing rates k/T
+            self.features[self.layer_idx][self.offset:self.offset+outputs.shape[1]] = torch.sum(outputs, dim=0).reshape(outputs.shape[1], -1).to(torch.uint8).cpu().numpy()
+        elif return_firing_rate:
+            self.features[self.layer_idx][self.offset:self.offset+outputs.shape[1]] = torch.mean(outputs, dim=0).reshape(outputs.shape[1], -1).cpu().numpy()
         else:
-            self.feature_single_layer.append(outputs.detach().cpu())
+            self.features[self.layer_idx].write(outputs.reshape(outputs.shape[0], outputs.shape[1], -1).to(torch.bool).cpu().numpy())     # one chunk per batch
+        
+        self.layer_idx += 1
     
 
-    def hook_registration(self, target_module=None) -> None:
+    def hook_registration(self, target_module=None, return_firing_rate=True) -> None:
             
         assert target_module is not None
         
-        self.feature_single_layer = []
         self.handles = []
         
         for _, _m in self.model.named_modules():
             
             if isinstance(_m, target_module):
                 
-                handle = _m.register_forward_hook(partial(self.hook_fn, return_firing_rate=args.return_firing_rate))
+                handle = _m.register_forward_hook(partial(self.hook_fn, return_firing_rate=return_firing_rate))
                 self.handles.append(handle)
 
-    
-    def features_transformation(self, return_firing_rate=True) -> None:
-        
-        num_samples = len(self.features)
-        num_layers = len(self.features[0])
-        
-        if return_firing_rate:
-            
-            self.features = [torch.stack([self.features[i_idx][l_idx] for i_idx in range(num_samples)], dim=0).reshape(num_samples, -1).numpy() for l_idx in tqdm(range(num_layers), desc='Transforming')]
-            
-        else:     # --- this may RAM consuming
-            
-            T = self.features[0][0].shape[0]
-            assert args.T == T
-            
-            self.features = [torch.stack([self.features[i_idx][l_idx] for i_idx in range(num_samples)], dim=1).reshape(T, num_samples, -1).numpy() for l_idx in tqdm(range(num_layers), desc='Transforming')]
-            
 
     def evaluate(self, args, verbose=True) -> None:
 
@@ -318,38 +371,90 @@ class SP_Extractor_SNN(SP_Trainer_SNN):
         
         with torch.inference_mode():
             
-            self.features = []
+            try:
+                
+                self.offset = 0     # sample offset of the current batch, the val sampler is sequential
             
-            for i, (image, target) in tqdm(enumerate(self.data_loader_val), desc='Extracting', total=len(self.data_loader_val)):
+                for i, (image, target) in tqdm(enumerate(self.data_loader_val), desc='Extracting', total=len(self.data_loader_val)):
                 
-                image = image.to(self.device, non_blocking=True)
-                target = target.to(self.device, non_blocking=True)
-                image = self.preprocess_test_sample(args, image)
+                    image = image.to(self.device, non_blocking=True)
+                    target = target.to(self.device, non_blocking=True)
+                    image = self.preprocess_test_sample(args, image)
+                
+                    self.layer_idx = 0
 
-                output = self.process_model_output(args, self.model(image))
-                loss = self.criterion(output, target)
+                    output = self.process_model_output(args, self.model(image))
+                    loss = self.criterion(output, target)
 
-                acc1, acc5 = self.cal_acc1_acc5(output, target)
-                batch_size = target.shape[0]
+                    acc1, acc5 = self.cal_acc1_acc5(output, target)
+                    batch_size = target.shape[0]
 
-                functional.reset_net(self.model)
+                    functional.reset_net(self.model)
                 
-                top1.update(acc1.item(), batch_size)
-                top5.update(acc5.item(), batch_size)
-                _loss.update(loss.item(), batch_size)
+                    top1.update(acc1.item(), batch_size)
+                    top5.update(acc5.item(), batch_size)
+                    _loss.update(loss.item(), batch_size)
                 
-                # --- features
-                self.features.append(self.feature_single_layer)
-                self.feature_single_layer = []
+                    # --- features
+                    assert self.layer_idx == len(self.features), f'[Coderror] {self.layer_idx} hooked outputs for {len(self.features)} layers'
+                    self.offset += batch_size
+            
+                assert self.offset == self.features[0].shape[-2], f'[Coderror] {self.offset} extracted samples for {self.features[0].shape[-2]} allocated'
             
-            for handle in self.handles:
-                handle.remove()
+            finally:     # --- also on failure, the model may be reused by another extractor
+                
+                for handle in self.handles:
+                    handle.remove()
 
         if verbose:
             print(f'Validation -> acc@1: {top1.avg:.3f}, acc@5: {top5.avg:.3f}, loss: {_loss.avg:.5f}')
             
             
 # ----------------------------------------------------------------------------------------------------------------------
+def get_features_path(args) -> str:
+    
+    save_path = os.path.join(args.FSA_root, args.FSA_dir, f'FSA {args.FSA_config}/Features')
+    os.makedirs(save_path, exist_ok=True)
+    
+    return save_path
+
+
+def allocate_features(layers, units, num_samples, save_path=None, dtype=np.float32) -> list:
+    """
+        one preallocated array per layer, the hooks write every batch at its sample offset, so the peak RAM is the 
+        final features size and does not depend on the batch size
+        
+        save_path: if given, each layer is created as a memory-mapped row-major staging file of the feature store 
+                   and the batches are written through to disk, save_features() transposes it into '{save_path}/{layer}.npy'
+    """
+    
+    if save_path is not None:
+        return [utils_.open_feature(os.path.join(save_path, f'{layer}'), (num_samples, u), dtype, staging=True) for layer, u in zip(layers, units)]
+    
+    return [np.empty((num_samples, u), dtype=dtype) for u in units]
+
+
+def use_spike_counts(args) -> bool:
+    """ uint8 spike counts hold at most T=255, longer simulations fall back to float32 firing rates """
+    
+    return args.spike_counts and args.T < 256
+
+
+def save_features(features, layers, save_path, num_classes=50, **kwargs) -> None:
+    """ kwargs: additional metadata of the feature store """
+    
+    for feature, _layer in tqdm(zip(features, layers), 'Saving Feature', total=len(layers)):
+        
+        num_samples = feature.shape[-2]//num_classes
+        
+        if isinstance(feature, utils_.Spike_Store_Writer):
+            feature.close(num_classes=num_classes, num_samples=num_samples)
+        elif isinstance(feature, np.memmap):
+            utils_.seal_feature(feature, os.path.join(save_path, f'{_layer}'), num_classes=num_classes, num_samples=num_samples, **kwargs)
+        else:
+            utils_.dump_feature(feature, os.path.join(save_path, f'{_layer}'), num_classes=num_classes, num_samples=num_samples, **kwargs)
+
+
 def get_layers_info(layers_info_generator, target_element='an') -> None:
     
     layers, units, shapes = layers_info_generator.get_layer_names_and_units_and_shapes()
@@ -388,15 +493,216 @@ def get_layers_info_generator_SNN(args, **kwargs):
 
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def load_manifest(file_path) -> list:
+    """ json list of jobs, or {'jobs': [...]} """
+    
+    with open(file_path, 'r') as f:
+        manifest = json.load(f)
+    
+    return manifest['jobs'] if isinstance(manifest, dict) else manifest
+
+
+class Extraction_Runner():
+    """
+        runs the jobs of a manifest in one process, reuses across jobs:
+            - datasets, per dataset config
+            - (layers, units, shapes), per architecture
+            - built models, per architecture, an idle model is taken from the pool and returned after the job
+        
+        max_jobs jobs run concurrently in threads, a job only starts if the in-RAM features of the running jobs and of 
+        itself fit into memory_budget (GB), a job larger than the budget runs alone
+    """
+    
+    def __init__(self, args, max_jobs=1, memory_budget=None, **kwargs) -> None:
+        
+        self.args = args
+        self.max_jobs = max_jobs
+        self.memory_budget = memory_budget*2**30 if memory_budget is not None else None
+        
+        self.datasets = {}
+        self.layers_info = {}
+        self.models = {}
+        
+        self.lock = threading.Lock()
+        self.budget = threading.Condition()
+        self.reserved = 0
+        
+    
+    @staticmethod
+    def NN_defaults(command) -> dict:
+        
+        if command == 'ANN':
+            return vars(ANN_extracting_parser(argparse.ArgumentParser()).parse_args([]))
+        elif command == 'SNN':
+            return vars(SNN_extracting_parser(argparse.ArgumentParser()).parse_args([]))
+        else:
+            raise ValueError(f'[Coderror] invalid command {command}')
+    
+    
+    def job_args(self, job) -> argparse.Namespace:
+        """ 
+            universal args < defaults of the NN args < NN args of the command line < job, the NN args of the command 
+            line are only inherited by jobs of the same command, e.g. an ANN job of an SNN command line does not take 
+            its model and T
+        """
+        
+        command = job.get('command', self.args.command)
+        
+        defaults = self.NN_defaults(command)
+        
+        cli_args = vars(self.args)
+        cli_NN_keys = set(self.NN_defaults(self.args.command)) if self.args.command in ['ANN', 'SNN'] else set()
+        
+        universal = {k: v for k, v in cli_args.items() if k not in cli_NN_keys}
+        NN_args = {k: v for k, v in cli_args.items() if k in cli_NN_keys and v is not None} if command == self.args.command else {}
+        
+        return argparse.Namespace(**{**universal, **defaults, **NN_args, **job, 'command': command})
+    
+    
+    @staticmethod
+    def dataset_key(args) -> tuple:
+        return tuple(getattr(args, _, None) for _ in ['data_path', 'hierarchy', 'split_ratio', 'val_resize_size', 'val_crop_size', 'interpolation', 'preprocessed_cache', 'preprocessed_dtype'])
+    
+    @staticmethod
+    def architecture_key(args) -> tuple:
+        return tuple(getattr(args, _, None) for _ in ['command', 'model', 'num_classes', 'neuron', 'surrogate', 'device'])
+    
+    
+    def get_datasets(self, args):
+        
+        with self.lock:
+            
+            if (key:=self.dataset_key(args)) not in self.datasets:
+                
+                trainer = SP_Extractor_ANN if args.command == 'ANN' else SP_Extractor_SNN
+                self.datasets[key] = trainer.prepare_datasets_tv(args) if args.hierarchy == 'tv' else trainer.prepare_datasets_cls(args, shuffle=False)
+            
+            return self.datasets[key]
+        
+    
+    def get_layers_info(self, args):
+        
+        with self.lock:
+            
+            if (key:=self.architecture_key(args)) not in self.layers_info:
+                
+                if args.command == 'ANN':
+                    self.layers_info[key] = get_layers_info(get_layers_info_generator_ANN(args), 'an')
+                else:
+                    self.layers_info[key] = get_layers_info(get_layers_info_generator_SNN(args), 'sn')
+            
+            return self.layers_info[key]
+        
+    
+    def acquire_model(self, args):
+        """ an idle built model of the architecture, None if the extractor has to build one """
+        
+        with self.lock:
+            
+            pool = self.models.setdefault(self.architecture_key(args), [])
+            
+            return pool.pop() if pool else None
+        
+    
+    def release_model(self, args, model) -> None:
+        
+        with self.lock:
+            self.models.setdefault(self.architecture_key(args), []).append(model)
+            
+    
+    def features_bytes(self, args, units, num_samples) -> int:
+        """ RAM of the features of one job, the memory-mapped and the spike store outputs are not counted """
+        
+        if args.extract_mmap or (args.command == 'SNN' and not args.return_firing_rate):
+            return 0
+        
+        itemsize = 1 if (args.command == 'SNN' and use_spike_counts(args)) else 4
+        
+        return sum(units)*num_samples*itemsize
+    
+    
+    def reserve(self, nbytes) -> None:
+        
+        if self.memory_budget is None:
+            return
+        
+        with self.budget:
+            self.budget.wait_for(lambda: self.reserved == 0 or self.reserved+nbytes <= self.memory_budget)
+            self.reserved += nbytes
+            
+    
+    def free(self, nbytes) -> None:
+        
+        if self.memory_budget is None:
+            return
+        
+        with self.budget:
+            self.reserved -= nbytes
+            self.budget.notify_all()
+            
+    
+    def run_job(self, job) -> None:
+        
+        args = self.job_args(job)
+        
+        datasets = self.get_datasets(args)
+        layers_info = self.get_layers_info(args)
+        
+        nbytes = self.features_bytes(args, layers_info[1], len(datasets[1]))
+        
+        self.reserve(nbytes)
+        
+        try:
+            
+            trainer = SP_Extractor_ANN if args.command == 'ANN' else SP_Extractor_SNN
+            
+            extractor = trainer(args, datasets=datasets, model=self.acquire_model(args))
+            
+            extractor.extract(args, layers_info=layers_info)
+            
+            self.release_model(args, extractor.model)     # only a model of a finished job goes back to the pool
+            
+        finally:
+            
+            self.free(nbytes)
+            
+    
+    def run(self, jobs) -> list:
+        """ returns the exceptions of the failed jobs as [(job, exception), ...], the other jobs continue """
+        
+        failed = []
+        
+        def _run_job(job):
+            try:
+                self.run_job(job)
+            except Exception as e:
+                traceback.print_exc()
+                failed.append((job, e))
+        
+        with ThreadPoolExecutor(max_workers=max(1, self.max_jobs)) as executor:
+            list(executor.map(_run_job, jobs))
+        
+        utils_.formatted_print(f'{len(jobs)-len(failed)}/{len(jobs)} extraction jobs finished')
+        
+        return failed
+
+
+
 # ======================================================================================================================
 if __name__ =="__main__":
     
     args = extracting_script_parser()
     
+    if args.manifest is not None:
+        
+        failed = Extraction_Runner(args, max_jobs=args.max_jobs, memory_budget=args.memory_budget).run(load_manifest(args.manifest))
+        
+        sys.exit(1 if failed else 0)
+    
     if args.command == 'ANN':
         extractor = SP_Extractor_ANN(args, shuffle=False)
     elif args.command == 'SNN':
         extractor = SP_Extractor_SNN(args, shuffle=False)
 
     extractor.extract(args)
-    
\ No newline at end of file
@@ -14,10 +14,14 @@ Created on Sun Feb 19 17:35:00 2023
 import os
 import time
 import argparse
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # --- local
 import similarity
 import utils_
+from similarity.FSA_DRG import FSA_DSM, FSA_Gram
+from similarity.FSA_Responses import calculation_Feature_Intensity_layer
 
 
 # ======================================================================================================================
@@ -39,6 +43,16 @@ def universal_similarity_parser(fold_idx=0):
 
     parser.add_argument("--model", type=str, default='resnet18')     
     
+    parser.add_argument("--mode", type=str, default='stage', choices=['stage', 'layer', 'scheduler'], help="'stage': each stage loops over all layers, 'layer': each layer is loaded once for all per-layer stages, 'scheduler': (stage, layer) tasks on a process pool")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="number of processes of the scheduler")
+    parser.add_argument("--worker_memory_gb", type=float, default=4., help="memory budget (GB) of each scheduler process")
+    
+    parser.add_argument("--SVM_kernel", type=str, default='rbf', choices=['rbf', 'linear'], help="precomputed kernel of the SVM decoding")
+    parser.add_argument("--SVM_cv_folds", type=int, default=None, help="stratified k-fold of the SVM decoding, None for the single train/test split")
+    parser.add_argument("--decoder", type=str, default='SVM', choices=['SVM', 'Ridge'], help="'SVM': the SVM decoding, 'Ridge': the closed-form linear Ridge decoding of all regularization values")
+    
+    parser.add_argument("--feature_cache_gb", type=float, default=0., help="memory budget (GB) of the feature cache shared by all analyzers, 0 (default) disables it")
+    
     return parser.parse_args()
 
 
@@ -55,17 +69,32 @@ class Face_Selectivity_Analyzer():
         
         self.FSA_folder = os.path.join(args.FSA_root, args.FSA_dir, f'FSA {args.FSA_config}')
         
+        utils_.set_feature_cache(int(args.feature_cache_gb*1024**3))     # each layer is read from disk once for all analyzers if it fits
+        
         # -----
         layers_info_generator, target_element = get_layers_info_generator_NN(args.model, **kwargs)
 
         self.layers, self.units, self.shapes = get_layers_info(layers_info_generator, target_element)
         
     
-    def selectivity_analysis_script(self, **kwargs) -> None:
+    def selectivity_analysis_script(self, mode='stage', **kwargs) -> None:
+        """
+            mode: 'stage' runs each stage over all layers in sequence, 'layer' runs self.layer_major_analysis() first so 
+                  all per-layer results are computed with one load of each layer, 'scheduler' runs the same per-layer 
+                  stages on a process pool with self.scheduled_analysis(), the stages below then only collect the saved 
+                  results
+        """
         
         start_time = time.time()
         
         # ---
+        if mode == 'layer':
+            self.layer_major_analysis(**kwargs)
+            
+        elif mode == 'scheduler':
+            utils_.set_num_workers(args.num_workers)     # <- also bounds the joblib workers of the stages below
+            self.scheduled_analysis(num_workers=args.num_workers, worker_memory_gb=args.worker_memory_gb, **kwargs)
+        
         self.neuron_selection_anova(**kwargs)
         
         self.neuron_selection_encode(**kwargs)
@@ -82,12 +111,162 @@ class Face_Selectivity_Analyzer():
         end_time = time.time()
         elapsed = end_time - start_time
         
+        utils_.formatted_print(f"Feature cache: {utils_.feature_cache_info()}")
         utils_.formatted_print(f"All results are saved in {os.path.join(self.FSA_folder, 'Analysis')}")
         utils_.formatted_print('Elapsed Time: {}:{:0>2}:{:0>2} '.format(int(elapsed/3600), int((elapsed%3600)/60), int((elapsed%3600)%60)))
         utils_.formatted_print('Experiment Done.')    
 
     
 
+    def layer_major_analysis(self, first_corr='pearson', kernel='linear', **kwargs) -> None:
+        """
+            load one layer, run ANOVA -> Encode -> Sort -> SVM -> DSM/Gram -> Intensity on it and free it before the next 
+            layer, the peak memory is one layer instead of the feature directory
+            
+            results are saved in the same files as the stage methods, so the cross-layer aggregation (pct, FDR, plots) is 
+            done by the stage methods afterwards, stages with existing results are skipped
+        """
+        
+        utils_.formatted_print('Executing layer_major_analysis...')
+        
+        stages, results = self.plan_layer_stages(first_corr=first_corr, kernel=kernel, **kwargs)
+        
+        if not stages:
+            return
+        
+        # --- layer-major loop
+        for layer in tqdm(self.layers, desc='Layer-major'):
+            
+            feature = utils_.load_feature(os.path.join(self.FSA_folder, 'Features', f'{layer}.pkl'), num_classes=args.num_classes, num_samples=args.num_samples, verbose=False)
+            
+            for stage, (func, analyzer, depends, stage_kwargs, _) in stages.items():     # in dependency order
+                
+                results[stage][layer] = func(analyzer, layer, *([results[depends][layer]] if depends else []), feature=feature, **stage_kwargs)
+            
+            del feature
+            
+        self.save_layer_stages(stages, results)
+        
+        
+    def scheduled_analysis(self, first_corr='pearson', kernel='linear', num_workers=None, worker_memory_gb=None, chunk_size=65536, **kwargs) -> None:
+        """
+            the same per-layer stages as self.layer_major_analysis() planned as (stage, layer) tasks on one bounded process 
+            pool, see Layer_Scheduler
+            
+            chunk_size: column chunk of the streamed stages (pearson DSM, Gram), as utils_.Feature_Memmap
+        """
+        
+        utils_.formatted_print('Executing scheduled_analysis...')
+        
+        stages, results = self.plan_layer_stages(first_corr=first_corr, kernel=kernel, **kwargs)
+        
+        if not stages:
+            return
+        
+        scheduler = Layer_Scheduler(num_workers=num_workers, worker_memory_gb=worker_memory_gb)
+        
+        streamed = {'DSM': first_corr == 'pearson', 'Gram': True}     # <- memmap tasks only hold one column chunk
+        
+        for stage, (func, analyzer, depends, stage_kwargs, _) in stages.items():
+            for idx, layer in enumerate(self.layers):
+                
+                columns = min(self.units[idx], chunk_size) if streamed.get(stage, False) else self.units[idx]
+                memory = 3*columns*args.num_classes*args.num_samples*4     # loaded feature (chunk) + working copies, float32
+                
+                if depends in stages:
+                    scheduler.add((stage, layer), func, analyzer, layer, depends=[(depends, layer)], memory=memory, **stage_kwargs)
+                elif depends is not None:
+                    scheduler.add((stage, layer), func, analyzer, layer, results[depends][layer], memory=memory, **stage_kwargs)
+                else:
+                    scheduler.add((stage, layer), func, analyzer, layer, memory=memory, **stage_kwargs)
+        
+        for (stage, layer), result in scheduler.run(desc='Scheduler').items():
+            results[stage][layer] = result
+            
+        self.save_layer_stages(stages, results)
+    
+    
+    def plan_layer_stages(self, first_corr='pearson', kernel='linear', **kwargs) -> tuple:
+        """
+            return:
+                stages: {stage: (task function, analyzer, dependency stage, task kwargs, save function)} of the per-layer 
+                        stages without saved results, in dependency order
+                results: {stage: {layer: result}}, prefilled with the saved ANOVA/Encode results needed by the stages
+        """
+        
+        analyzer_config = {'root': self.FSA_folder, 'layers': self.layers, 'units': self.units, 'num_classes': args.num_classes, 'num_samples': args.num_samples}
+        
+        ANOVA_analyzer = similarity.FSA_ANOVA(alpha=args.alpha, **analyzer_config)
+        Encode_analyzer = similarity.FSA_Encode(**analyzer_config)
+        SVM_analyzer = similarity.FSA_SVM(SVM_kernel=args.SVM_kernel, cv_folds=args.SVM_cv_folds, **analyzer_config)
+        DSM_analyzer = FSA_DSM(**analyzer_config)
+        Gram_analyzer = FSA_Gram(**analyzer_config)
+        Responses_analyzer = similarity.FSA_Responses(**analyzer_config)
+        
+        used_unit_types = Encode_analyzer.basic_types_display + Encode_analyzer.advanced_types_display + ['a_s', 'a_m']
+        Intensity_unit_types = Encode_analyzer.advanced_types_display
+        
+        # --- save functions, {layer: result} in the order of self.layers
+        def _save_ANOVA(results):
+            ANOVA_analyzer.ANOVA_idces = {k: v[0] for k, v in results.items()}
+            ANOVA_analyzer.ANOVA_stats = {k: v[1] for k, v in results.items()}
+            ANOVA_analyzer.save_ANOVA()
+            
+        def _save_Encode(results):
+            Encode_analyzer.Encode_dict = {k: v[0] for k, v in results.items()}
+            Encode_analyzer.Sort_dict = {k: v[1] for k, v in results.items()}
+            Encode_analyzer.save_Encode()
+        
+        # ---
+        stages = {
+            'ANOVA': (task_ANOVA, ANOVA_analyzer, None, kwargs, _save_ANOVA),
+            'Encode': (task_Encode, Encode_analyzer, 'ANOVA', kwargs, _save_Encode),
+            'SVM': (task_SVM, SVM_analyzer, 'Encode', {'used_unit_types': used_unit_types}, lambda _: SVM_analyzer.save_SVM(_, used_unit_types)),
+            'Ridge': (task_Ridge, SVM_analyzer, 'Encode', {'used_unit_types': used_unit_types}, lambda _: SVM_analyzer.save_Ridge(_, used_unit_types)),
+            'DSM': (task_DSM, DSM_analyzer, 'Encode', {'used_unit_types': used_unit_types, 'metric': first_corr}, lambda _: DSM_analyzer.save_DSM(_, first_corr, used_unit_types)),
+            'Gram': (task_Gram, Gram_analyzer, 'Encode', {'used_unit_types': used_unit_types, 'kernel': kernel, 'normalize': True}, lambda _: Gram_analyzer.save_Gram(_, kernel, True)),
+            'Intensity': (task_Intensity, Encode_analyzer, 'Encode', {'used_unit_types': Intensity_unit_types}, lambda _: Responses_analyzer.save_Feature_Intensity(_, Intensity_unit_types)),
+            }
+        
+        saved = {
+            'ANOVA': utils_.cache_hit(ANOVA_analyzer.ANOVA_paths, **ANOVA_analyzer.ANOVA_cache()),
+            'Encode': utils_.cache_hit(Encode_analyzer.Encode_paths, **Encode_analyzer.Encode_cache()),
+            'SVM': utils_.cache_hit(SVM_analyzer.SVM_path, **SVM_analyzer.SVM_cache(used_unit_types)),
+            'Ridge': utils_.cache_hit(SVM_analyzer.Ridge_path(), **SVM_analyzer.Ridge_cache(used_unit_types)),
+            'DSM': utils_.cache_hit(DSM_analyzer.DSM_path(first_corr), **DSM_analyzer.DSM_cache(first_corr, used_unit_types)),
+            'Gram': utils_.cache_hit(Gram_analyzer.Gram_path(kernel, True), **Gram_analyzer.Gram_cache(kernel, True)),
+            'Intensity': utils_.cache_hit(Responses_analyzer.Intensity_path, **Responses_analyzer.Intensity_cache(Intensity_unit_types)),
+            }
+        
+        for k in ['SVM', 'Ridge']:     # only the selected decoder
+            if k != args.decoder:
+                stages.pop(k), saved.pop(k)
+        
+        for k, (_, _, depends, _, _) in stages.items():     # in dependency order, a recomputed stage invalidates its dependents
+            saved[k] = saved[k] and (depends is None or saved[depends])
+        
+        stages = {k: v for k, v in stages.items() if not saved[k]}
+        results = {k: {} for k in stages}
+        
+        # --- saved results used by the stages to run
+        if saved['ANOVA'] and 'Encode' in stages:
+            ANOVA_idces, ANOVA_stats = ANOVA_analyzer.load_ANOVA_idces(), ANOVA_analyzer.load_ANOVA_stats()
+            results['ANOVA'] = {layer: (ANOVA_idces[layer], ANOVA_stats[layer]) for layer in self.layers}
+            
+        if saved['Encode'] and stages.keys()-{'ANOVA', 'Encode'}:
+            Sort_dict = Encode_analyzer.load_Sort_dict()
+            results['Encode'] = {layer: (None, Sort_dict[layer]) for layer in self.layers}
+        
+        return stages, results
+    
+    
+    def save_layer_stages(self, stages, results) -> None:
+        """ save the results of the per-layer stages in the same files as the stage methods """
+        
+        for stage, (*_, save) in stages.items():
+            save({layer: results[stage][layer] for layer in self.layers})
+        
+    
     def neuron_selection_anova(self, **kwargs) -> None:
         
         FSA_ANOVA_analyzer = similarity.FSA_ANOVA(root=self.FSA_folder, 
@@ -127,9 +306,14 @@ class Face_Selectivity_Analyzer():
         
         SVM_analyzer = similarity.FSA_SVM(root=self.FSA_folder, 
                                           layers=self.layers, 
-                                          units=self.units)
-        
-        SVM_analyzer.process_SVM(**kwargs)
+                                          units=self.units,
+                                          SVM_kernel=args.SVM_kernel,
+                                          cv_folds=args.SVM_cv_folds)
+        
+        if args.decoder == 'SVM':
+            SVM_analyzer.process_SVM(**kwargs)
+        elif args.decoder == 'Ridge':
+            SVM_analyzer.process_Ridge(**kwargs)
 
         
     def neuron_population_RSA(self, **kwargs) -> None:
@@ -174,6 +358,129 @@ class Face_Selectivity_Analyzer():
             CKA_human_analyzer.process_all_used_unit_results(used_id_num=used_id_num, used_unit_types=self.used_types_Similarity)
        
 
+# ----------------------------------------------------------------------------------------------------------------------
+class Layer_Scheduler():
+    """
+        plans the work as (stage, layer) tasks with declared dependencies and runs them on one bounded process pool
+        
+        a task is submitted once its dependencies are done and a worker is free, each worker runs one task at a time so 
+        worker_memory_gb caps the estimated memory of every task, a task over the cap is serialized: it is submitted to an 
+        idle pool only and nothing else is submitted until it is done
+    """
+    
+    def __init__(self, num_workers=None, worker_memory_gb=None, **kwargs):
+        
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.worker_memory = float('inf') if worker_memory_gb is None else worker_memory_gb*1024**3
+        
+        self.tasks = {}     # <- {key: (func, args, kwargs, depends, memory)}, insertion order is the priority
+        
+    
+    def add(self, key, func, *args, depends=(), memory=0, **kwargs):
+        """ func(*args, *[results of depends], **kwargs) is executed in a worker, func and args must be picklable """
+        
+        assert key not in self.tasks, f'[Coderror] duplicated task {key}'
+        
+        self.tasks[key] = (func, args, kwargs, tuple(depends), memory)
+        
+        return key
+    
+    
+    def run(self, desc='Scheduler') -> dict:
+        
+        for key, (*_, depends, _) in self.tasks.items():
+            for _ in depends:
+                assert _ in self.tasks, f'[Coderror] task {key} depends on unknown task {_}'
+        
+        results = {}
+        running = {}
+        pending = list(self.tasks)
+        exclusive = False     # <- a task over the cap of one worker is running
+        
+        with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_worker_initializer) as pool, tqdm(total=len(self.tasks), desc=desc) as pbar:
+            
+            while pending or running:
+                
+                # --- submit
+                for key in list(pending):
+                    
+                    if len(running) >= self.num_workers or exclusive:
+                        break
+                    
+                    func, args, kwargs, depends, memory = self.tasks[key]
+                    
+                    if not all(_ in results for _ in depends) or (running and memory > self.worker_memory):
+                        continue
+                    
+                    running[pool.submit(func, *args, *[results[_] for _ in depends], **kwargs)] = key
+                    pending.remove(key)
+                    exclusive = memory > self.worker_memory
+                    
+                if not running:
+                    raise RuntimeError(f'[Coderror] circular dependencies in {pending}')
+                
+                # --- collect
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    
+                    key = running.pop(future)
+                    results[key] = future.result()
+                    exclusive = exclusive and self.tasks[key][-1] <= self.worker_memory     # <- the serialized task is done
+                    
+                    pbar.update(1)
+                    
+        return results
+    
+
+def _worker_initializer():
+    """ one worker per task, no nested joblib workers and no feature cache inside the workers """
+    
+    utils_.set_num_workers(1)
+    utils_.set_feature_cache(0)
+
+
+# --- per-layer tasks, module-level to be picklable, the feature is loaded inside the task if not given
+def _load_layer(analyzer, layer, **kwargs):
+    return utils_.load_feature(os.path.join(analyzer.root, f'{layer}.pkl'), num_classes=analyzer.num_classes, num_samples=analyzer.num_samples, verbose=False, **kwargs)
+
+
+def task_ANOVA(analyzer, layer, feature=None, **kwargs) -> tuple:
+    feature = _load_layer(analyzer, layer) if feature is None else feature
+    return analyzer.calculation_ANOVA_layer(feature, layer, **kwargs)
+
+
+def task_Encode(analyzer, layer, ANOVA_result, feature=None, **kwargs) -> tuple:
+    feature = _load_layer(analyzer, layer) if feature is None else feature
+    return analyzer.calculation_Encode_layer(feature, ANOVA_result[0], **kwargs)
+
+
+def task_SVM(analyzer, layer, Encode_result, used_unit_types, feature=None, **kwargs) -> dict:
+    feature = _load_layer(analyzer, layer) if feature is None else feature
+    return analyzer.calculation_SVM_layer(feature, Encode_result[1], used_unit_types)
+
+
+def task_Ridge(analyzer, layer, Encode_result, used_unit_types, feature=None, **kwargs) -> dict:
+    feature = _load_layer(analyzer, layer) if feature is None else feature
+    return analyzer.calculation_Ridge_layer(feature, Encode_result[1], used_unit_types)
+
+
+def task_DSM(analyzer, layer, Encode_result, used_unit_types, metric='pearson', feature=None, **kwargs) -> dict:
+    feature = _load_layer(analyzer, layer, mmap=metric=='pearson') if feature is None else feature
+    return analyzer.calculation_DSM_layer(feature, analyzer.calculation_Sort_dict_layer(Encode_result[1], used_unit_types), metric, used_unit_types)
+
+
+def task_Gram(analyzer, layer, Encode_result, used_unit_types, kernel='linear', normalize=True, feature=None, **kwargs) -> dict:
+    feature = _load_layer(analyzer, layer, normalize=normalize, mmap=True) if feature is None else feature
+    return analyzer.calculation_Gram_layer(feature, Encode_result[1], kernel)
+
+
+def task_Intensity(analyzer, layer, Encode_result, used_unit_types, feature=None, **kwargs) -> dict:
+    feature = _load_layer(analyzer, layer) if feature is None else feature
+    return calculation_Feature_Intensity_layer(feature, analyzer.calculation_Sort_dict_layer(Encode_result[1], used_unit_types), num_classes=analyzer.num_classes, num_samples=analyzer.num_samples)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
 def get_layers_info(layers_info_generator, target_element='an') -> None:
     
     layers, units, shapes = layers_info_generator.get_layer_names_and_units_and_shapes()
@@ -228,5 +535,5 @@ if __name__ == "__main__":
     
     FSA_analyzer = Face_Selectivity_Analyzer(args)
     
-    FSA_analyzer.selectivity_analysis_script()
+    FSA_analyzer.selectivity_analysis_script(mode=args.mode)
     
@@ -14,6 +14,7 @@ Created on Thu Feb  9 12:53:33 2023
 
 # --- python
 import os
+import re
 import math
 import warnings
 #import logging
@@ -21,7 +22,6 @@ import numpy as np
 from tqdm import tqdm
 import scipy.stats as stats
 import matplotlib.pyplot as plt
-from joblib import Parallel, delayed
 
 # --- local
 import utils_
@@ -62,7 +62,8 @@ class FSA_ANOVA():
     
     def _check_layers(self, ):     # --- running check for units inside the loop by default
         
-        pkls_set = {os.path.splitext(_)[0] for _ in os.listdir(self.root)}
+        # --- '{layer}.pkl', '{layer}.npy' + '.json' (feature store), '{layer}_spikes/' (spike store), '{layer}_cumulative.npy'
+        pkls_set = {re.sub(r'_(spikes|cumulative)$', '', os.path.splitext(_)[0]) for _ in os.listdir(self.root) if not _.startswith('.')}
         layers_set = set(self.layers)
         
         assert pkls_set == layers_set, "The layers and features are mismatch"
@@ -85,19 +86,16 @@ class FSA_ANOVA():
         plt.close()
     
 
-    def calculation_ANOVA(self, normalize=True, sort=True, num_workers=-1, **kwargs):
+    def calculation_ANOVA(self, normalize=True, sort=True, chunk_size=8192, **kwargs):
         """
             normalize: if True, normalize the feature map
             sort: if True, sort the featuremap from lexicographic order (pytorch) into natural order
-            num_workers: parallel workers for joblib
+            chunk_size: number of units tested together, bounds the memory of the batched ANOVA
         """
         
         utils_.formatted_print('Executing calculation_ANOVA')
         
-        idces_path = os.path.join(self.dest_ANOVA, 'ANOVA_idces.pkl')
-        stats_path = os.path.join(self.dest_ANOVA, 'ANOVA_stats.pkl')
-        
-        if os.path.exists(idces_path) and os.path.exists(stats_path):
+        if utils_.cache_hit(self.ANOVA_paths, **self.ANOVA_cache(normalize, sort)):
             self.ANOVA_idces = self.load_ANOVA_idces()
             self.ANOVA_stats = self.load_ANOVA_stats()
         
@@ -105,25 +103,56 @@ class FSA_ANOVA():
             self.ANOVA_idces = {}
             self.ANOVA_stats = {}     # <- p_values
             
-            for idx, layer in enumerate(self.layers):     # for each layer
+            for layer in self.layers:     # for each layer
     
                 feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), normalize=normalize, sort=sort, verbose=False, **kwargs)
 
-                if feature.shape[0] != self.num_classes*self.num_samples or feature.shape[1] != self.units[idx]:     # running check
-                    raise AssertionError('[Coderror] feature.shape[0] ({}) != self.num_classes*self.num_samples ({},{}) or feature.shape[1] ({}) != self.units[idx] ({})'.format(feature.shape[0], self.num_classes, self.num_samples, feature.shape[1], self.units[idx]))
-                
-                # ----- joblib
-                pl = Parallel(n_jobs=num_workers)(delayed(one_way_ANOVA)(feature[:, i]) for i in tqdm(range(feature.shape[1]), desc=f'ANOVA [{layer}]'))
-    
-                neuron_idx = np.array([idx for idx, p in enumerate(pl) if p < self.alpha])
-            
-                self.ANOVA_stats[layer] = pl
-                self.ANOVA_idces[layer] = neuron_idx
+                self.ANOVA_idces[layer], self.ANOVA_stats[layer] = self.calculation_ANOVA_layer(feature, layer, chunk_size=chunk_size)
             
-            utils_.dump(self.ANOVA_idces, idces_path)
-            utils_.dump(self.ANOVA_stats, stats_path)
+            self.save_ANOVA(normalize, sort)
             
-            utils_.formatted_print('ANOVA results have been saved in {}'.format(self.dest_ANOVA))
+    
+    @property
+    def ANOVA_paths(self) -> tuple:
+        return os.path.join(self.dest_ANOVA, 'ANOVA_idces.pkl'), os.path.join(self.dest_ANOVA, 'ANOVA_stats.pkl')
+    
+    
+    def ANOVA_cache(self, normalize=True, sort=True, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the ANOVA results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'ANOVA',
+            'params': {'alpha': self.alpha, 'normalize': normalize, 'sort': sort, 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers)},
+            'inputs': utils_.feature_inputs(self.root, self.layers)
+            }
+    
+    
+    def calculation_ANOVA_layer(self, feature, layer, chunk_size=8192, **kwargs) -> tuple:
+        """ ANOVA of one loaded layer, returns (neuron_idx, p_values) """
+        
+        idx = list(self.layers).index(layer)
+        
+        if feature.shape[0] != self.num_classes*self.num_samples or feature.shape[1] != self.units[idx]:     # running check
+            raise AssertionError('[Coderror] feature.shape[0] ({}) != self.num_classes*self.num_samples ({},{}) or feature.shape[1] ({}) != self.units[idx] ({})'.format(feature.shape[0], self.num_classes, self.num_samples, feature.shape[1], self.units[idx]))
+        
+        # ----- batched, all units of the layer
+        _, pl = one_way_ANOVA_batch(feature, num_classes=self.num_classes, num_samples=self.num_samples, chunk_size=chunk_size, desc=f'ANOVA [{layer}]')
+
+        neuron_idx = np.flatnonzero(pl < self.alpha)     # nan values are filtered out here
+        
+        return neuron_idx, pl
+    
+    
+    def save_ANOVA(self, normalize=True, sort=True, **kwargs):
+        
+        idces_path, stats_path = self.ANOVA_paths
+        
+        utils_.dump(self.ANOVA_idces, idces_path)
+        utils_.dump(self.ANOVA_stats, stats_path)
+        
+        utils_.cache_seal(self.ANOVA_paths, **self.ANOVA_cache(normalize, sort))
+        
+        utils_.formatted_print('ANOVA results have been saved in {}'.format(self.dest_ANOVA))
             
             
     def calculation_ANOVA_pct(self, ANOVA_path=None, **kwargs):
@@ -199,6 +228,43 @@ def one_way_ANOVA(input, num_classes=50, num_samples=10, **kwargs):
     return p
 
 
+def one_way_ANOVA_batch(input, num_classes=50, num_samples=10, chunk_size=8192, desc=None, **kwargs):
+    """
+        batched version of one_way_ANOVA(), tests every column of the (num_classes*num_samples, num_units) input at 
+        once on the reshaped (num_classes, num_samples, num_units) tensor, chunked over units to bound the memory
+        
+        the same as stats.f_oneway(), the all 0 units return 'nan' F_value and 'nan' p_value, the units with constant 
+        values inside every class return 'inf' F_value and 0. p_value
+        
+        return:
+            F_values, p_values: (num_units,)
+    """
+    
+    num_units = input.shape[1]
+    
+    df_between = num_classes - 1
+    df_within = num_classes*num_samples - num_classes
+    
+    F = np.empty(num_units, dtype=np.float64)
+    
+    for start in tqdm(range(0, num_units, chunk_size), desc=desc, disable=desc is None):
+        
+        x = np.asarray(input[:, start:start+chunk_size], dtype=np.float64).reshape(num_classes, num_samples, -1)     # (50, 10, chunk_size)
+        
+        class_means = np.mean(x, axis=1)     # (50, chunk_size)
+        grand_mean = np.mean(class_means, axis=0)     # balanced design
+        
+        ss_between = num_samples*np.sum((class_means-grand_mean)**2, axis=0)
+        ss_within = np.sum((x-class_means[:, None, :])**2, axis=(0, 1))
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            F[start:start+chunk_size] = (ss_between/df_between)/(ss_within/df_within)
+    
+    p = stats.f.sf(F, df_between, df_within)     # sf(nan) -> nan, sf(inf) -> 0.
+    
+    return F, p
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def plot_ANOVA_pct(ax, layers, pcts, bar_colors=None, line_color=None, linewidth=2.5, label=None, **kwargs):
     
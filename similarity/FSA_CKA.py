@@ -85,43 +85,26 @@ class CKA_Similarity_base():
         else:
             raise ValueError
         
-        if os.path.exists(save_path):
+        # --- the NN Grams are the upstream input, the primate references are fixed by primate/used_unit_type/used_id_num
+        CKA_cache = {
+            'stage': 'CKA',
+            'params': {'kernel': kernel, 'primate': primate, 'used_unit_type': used_unit_type, 'used_id_num': used_id_num, 'alpha': alpha, 'FDR_method': FDR_method, 'layers': list(self.layers), 'kwargs': kwargs},
+            'inputs': [self.Gram_path(kernel, **kwargs)]
+            }
+        
+        if utils_.cache_hit(save_path, **CKA_cache):
             
             cka_dict = utils_.load(save_path, verbose=False)
             
         else:
             
-            def _calculation_CKA(layer, **kwargs):    
-
-                corr_coef = utils_similarity.cka(self.primate_Gram, self.NN_Gram_dict[layer], **kwargs)
-                corr_coef_perm = np.array([utils_similarity.cka(_, self.NN_Gram_dict[layer], **kwargs) for _ in self.primate_Gram_perm])
-                
-                if np.isnan(corr_coef):
-                    p_perm = np.nan
-                else:
-                    p_perm = np.mean(corr_coef_perm > corr_coef)     # equal to: np.sum(corr_coef_perm > corr_coef)/num_perm,
-                
-                # --- temporal
-                corr_coef_temporal = utils_similarity.cka_temporal(self.primate_Gram_temporal, self.NN_Gram_dict[layer], **kwargs)     # (time_steps, )
-                corr_coef_temporal_perm = np.array([utils_similarity.cka_temporal( _, self.NN_Gram_dict[layer], **kwargs) for _ in self.primate_Gram_temporal_perm])
+            # --- primate references and NN Grams are shared once, tasks receive only handles
+            with utils_.Shared_Arrays() as shared:
                 
-                p_perm_temporal = np.array([np.mean(corr_coef_temporal_perm[:, _] > corr_coef_temporal[_]) if not np.isnan(corr_coef_temporal[_]) else np.nan for _ in range(len(corr_coef_temporal))])
-                
-                # ---
-                return {
-                    'corr_coef': corr_coef,
-                    'corr_coef_perm': corr_coef_perm,
-                    'p_perm': p_perm,     
-                    
-                    'corr_coef_temporal': corr_coef_temporal,
-                    'corr_coef_temporal_perm': corr_coef_temporal_perm,
-                    'p_perm_temporal': p_perm_temporal
-                    }
-            
-            #for layer in self.layers[-2:]:
-            #    _calculation_CKA(layer, **kwargs)
+                primate_Grams = {_: shared.put(getattr(self, _)) for _ in ['primate_Gram', 'primate_Gram_perm', 'primate_Gram_temporal', 'primate_Gram_temporal_perm']}
+                NN_Grams = {layer: shared.put(np.asarray(self.NN_Gram_dict[layer])) for layer in self.layers}
             
-            pl = Parallel(n_jobs=int(os.cpu_count()/2))(delayed(_calculation_CKA)(layer, **kwargs) for layer in tqdm(self.layers, desc=f'CKA {primate}'))
+                pl = Parallel(n_jobs=utils_.get_num_workers(int(os.cpu_count()/2)))(delayed(calculation_CKA_layer)(NN_Grams[layer], **primate_Grams, **kwargs) for layer in tqdm(self.layers, desc=f'CKA {primate}'))
             
             pl_k = ['corr_coef', 'corr_coef_perm', 'p_perm', 'corr_coef_temporal', 'corr_coef_temporal_perm', 'p_perm_temporal']
         
@@ -162,6 +145,7 @@ class CKA_Similarity_base():
                 }
                 
             utils_.dump(cka_dict, save_path, verbose=False)
+            utils_.cache_seal(save_path, **CKA_cache)
 
         return cka_dict
     
@@ -216,6 +200,43 @@ class CKA_Similarity_base():
             utils_similarity.fake_legend_describe_numpy(ax, CKA_dict['similarity_temporal'], CKA_dict[EC].astype(bool), **kwargs)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def calculation_CKA_layer(NN_Gram, primate_Gram, primate_Gram_perm, primate_Gram_temporal, primate_Gram_temporal_perm, **kwargs):
+    """
+        CKA of one layer with the permutation test, arrays can be passed as utils_.Shared_Handle
+        
+        input shape: NN - (n, n); Bio - (n, n), (num_perm, n, n), (time_steps, n, n), (num_perm, time_steps, n, n) or the 
+                     lazy Permuted_Stats
+    """
+    
+    NN_Gram, primate_Gram, primate_Gram_perm, primate_Gram_temporal, primate_Gram_temporal_perm = [utils_.shared_load(_) for _ in (NN_Gram, primate_Gram, primate_Gram_perm, primate_Gram_temporal, primate_Gram_temporal_perm)]
+    
+    corr_coef = utils_similarity.cka(primate_Gram, NN_Gram, **kwargs)
+    corr_coef_perm = utils_similarity.cka_batch(primate_Gram_perm, NN_Gram, **kwargs)     # (num_perm, )
+    
+    if np.isnan(corr_coef):
+        p_perm = np.nan
+    else:
+        p_perm = np.mean(corr_coef_perm > corr_coef)     # equal to: np.sum(corr_coef_perm > corr_coef)/num_perm,
+    
+    # --- temporal
+    corr_coef_temporal = utils_similarity.cka_batch(primate_Gram_temporal, NN_Gram, **kwargs)     # (time_steps, )
+    corr_coef_temporal_perm = utils_similarity.cka_batch(primate_Gram_temporal_perm, NN_Gram, **kwargs)     # (num_perm, time_steps)
+    
+    p_perm_temporal = np.array([np.mean(corr_coef_temporal_perm[:, _] > corr_coef_temporal[_]) if not np.isnan(corr_coef_temporal[_]) else np.nan for _ in range(len(corr_coef_temporal))])
+    
+    # ---
+    return {
+        'corr_coef': corr_coef,
+        'corr_coef_perm': corr_coef_perm,
+        'p_perm': p_perm,     
+        
+        'corr_coef_temporal': corr_coef_temporal,
+        'corr_coef_temporal_perm': corr_coef_temporal_perm,
+        'p_perm_temporal': p_perm_temporal
+        }
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class CKA_Monkey(monkey_feature_process, FSA_Gram, CKA_Similarity_base):
     """
@@ -339,8 +360,8 @@ class CKA_Human(human_feature_process, FSA_Gram, CKA_Similarity_base):
             
         self.primate_Gram = Gram
         self.primate_Gram_temporal = np.array([_ for _ in Gram_temporal])
-        self.primate_Gram_perm = np.array([_ for _ in Gram_perm])
-        self.primate_Gram_temporal_perm = np.array([np.array([__ for __ in _]) for _ in Gram_temporal_perm])
+        self.primate_Gram_perm = Gram_perm     # lazy Permuted_Stats, centered once and gathered per chunk by cka_batch()
+        self.primate_Gram_temporal_perm = Gram_temporal_perm
         
         # ----- calculation
         cka_dict = self.calculation_CKA_Similarity(kernel=kernel, used_unit_type=used_unit_type, used_id_num=used_id_num, primate='Human', **kwargs)
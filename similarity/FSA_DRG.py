@@ -240,9 +240,9 @@ class FSA_DSM(FSA_Encode):
         
         used_unit_types = self.basic_types_display + self.advanced_types_display + ['a_s', 'a_m'] if used_unit_types is None else used_unit_types
 
-        save_path = os.path.join(self.dest_DSM, f'{metric}.pkl')
+        save_path = self.DSM_path(metric)
         
-        if os.path.exists(save_path):
+        if utils_.cache_hit(save_path, **self.DSM_cache(metric, used_unit_types, **kwargs)):
             
             DSM_dict = utils_.load(save_path, verbose=False)
             
@@ -254,17 +254,63 @@ class FSA_DSM(FSA_Encode):
 
             for layer in tqdm(self.layers, desc=f'{self.model_structure} DSM({metric})'):     # for each layer
 
-                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), verbose=False, **kwargs)     # (500, num_samples)
-                feature = np.mean(feature.reshape(self.num_classes, self.num_samples, -1), axis=1)     # (50, num_samples)
-                
-                pl = Parallel(n_jobs=int(os.cpu_count()/2))(delayed(utils_similarity.DSM_calculation)(feature[:, self.Sort_dict[layer][k].astype(int)], metric, **kwargs) for k in used_unit_types)
+                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), mmap=metric=='pearson', verbose=False, **kwargs)     # (500, num_samples)
                 
-                DSM_dict[layer] = {k: pl[idx] for idx, k in enumerate(used_unit_types)}
+                DSM_dict[layer] = self.calculation_DSM_layer(feature, self.Sort_dict[layer], metric, used_unit_types, **kwargs)
                 
-            utils_.dump(DSM_dict, save_path, verbose=True)
+            self.save_DSM(DSM_dict, metric, used_unit_types, **kwargs)
 
         return DSM_dict
     
+    
+    def DSM_path(self, metric='pearson') -> str:
+        return os.path.join(self.dest_DSM, f'{metric}.pkl')
+    
+    
+    def DSM_cache(self, metric='pearson', used_unit_types=None, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the DSM results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'DSM',
+            'params': {'metric': metric, 'used_unit_types': list(used_unit_types), 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers), 
+                       **_cache_kwargs(kwargs, normalize=True, sort=True, select_ratio=0, vectorize=False)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.Sort_dict_path]
+            }
+    
+    
+    def save_DSM(self, DSM_dict, metric='pearson', used_unit_types=None, **kwargs) -> None:
+        
+        utils_.dump(DSM_dict, self.DSM_path(metric), tool='pickle5', verbose=True)
+        utils_.cache_seal(self.DSM_path(metric), **self.DSM_cache(metric, used_unit_types, **kwargs))
+    
+    
+    def calculation_DSM_layer(self, feature, sort_dict, metric='pearson', used_unit_types=None, **kwargs) -> dict:
+        """ 
+            DSM of one loaded (500, num_units) layer for every used unit type, the pearson DSM is computed from the 
+            streamed moments for both ndarray and Feature_Memmap, so all modes produce the same result 
+        """
+        
+        if metric == 'pearson':
+            
+            moments = calculation_unit_type_moments(feature, sort_dict, used_unit_types, self.num_classes, self.num_samples)
+            
+            DSM_dict = {}
+            
+            for k, (num_units, row_sum, dot_products, nan_detected) in moments.items():
+                
+                if nan_detected:     # masked pairwise corrcoef, fall back to the loaded class-mean matrix of this type
+                    DSM_dict[k] = utils_similarity.DSM_calculation(np.mean(feature[:, sort_dict[k].astype(int)].reshape(self.num_classes, self.num_samples, -1), axis=1), metric, **kwargs)
+                else:
+                    DSM_dict[k] = utils_similarity.DSM_pearson_from_moments(num_units, row_sum, dot_products, num_calsses=self.num_classes, **kwargs)
+            
+            return DSM_dict
+        
+        feature = np.mean(feature.reshape(self.num_classes, self.num_samples, -1), axis=1)     # (50, num_samples)
+        
+        pl = Parallel(n_jobs=utils_.get_num_workers(int(os.cpu_count()/2)))(delayed(utils_similarity.DSM_calculation)(feature[:, sort_dict[k].astype(int)], metric, **kwargs) for k in used_unit_types)
+        
+        return {k: pl[idx] for idx, k in enumerate(used_unit_types)}
+    
 
     def plot_DSM(self, metric, DSM_dict, used_unit_types, vlim:tuple=None, cmap='turbo', **kwargs) -> None:
 
@@ -312,6 +358,54 @@ class FSA_DSM(FSA_Encode):
         plt.close()
 
     
+# ----------------------------------------------------------------------------------------------------------------------
+def _cache_kwargs(kwargs, **defaults) -> dict:
+    """ the kwargs which change the results, with their defaults, the others (verbose, pass-through args...) are not keyed """
+    
+    return {k: kwargs.get(k, v) for k, v in defaults.items()}
+
+
+def calculation_unit_type_moments(feature, sort_dict, used_unit_types, num_classes=50, num_samples=10, chunk_size=None, **kwargs) -> dict:
+    """
+        streaming moments of the (num_classes, num_units) class-mean matrix X of every unit type, the Feature_Memmap is 
+        read by column chunks so the peak memory is bounded by chunk_size, a loaded ndarray is read in one chunk
+        
+        return: {unit_type: (num_units, X.sum(1), X·Xᵀ, nan_detected)}, accumulated in float64
+    """
+    
+    chunk_size = getattr(feature, 'chunk_size', max(1, feature.shape[1])) if chunk_size is None else chunk_size
+    
+    indices = {k: np.sort(sort_dict[k].astype(int)) for k in used_unit_types}
+    
+    num_units = {k: v.size for k, v in indices.items()}
+    row_sum = {k: np.zeros(num_classes) for k in used_unit_types}
+    dot_products = {k: np.zeros((num_classes, num_classes)) for k in used_unit_types}
+    nan_detected = {k: False for k in used_unit_types}
+    
+    for start in range(0, feature.shape[1], chunk_size):
+        
+        stop = min(start+chunk_size, feature.shape[1])
+        
+        local_indices = {k: v[np.searchsorted(v, start):np.searchsorted(v, stop)]-start for k, v in indices.items()}
+        
+        if not any(_.size for _ in local_indices.values()):
+            continue
+        
+        X = np.mean(feature[:, start:stop].reshape(num_classes, num_samples, -1), axis=1, dtype=np.float64)     # (50, chunk_size)
+        
+        for k, v in local_indices.items():
+            
+            if v.size:
+                
+                X_k = X[:, v]
+                
+                row_sum[k] += X_k.sum(axis=1)
+                dot_products[k] += X_k @ X_k.T
+                nan_detected[k] |= bool(np.isnan(X_k).any())
+    
+    return {k: (num_units[k], row_sum[k], dot_products[k], nan_detected[k]) for k in used_unit_types}
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class FSA_Gram(FSA_Encode):
 
@@ -328,48 +422,81 @@ class FSA_Gram(FSA_Encode):
     def calculation_Gram(self, kernel='linear', normalize=True, **kwargs):
         
         
-        if kernel == 'rbf' and 'threshold' in kwargs:
-            save_path = os.path.join(self.dest_Gram, f"Gram_{kernel}_{kwargs['threshold']}_norm_{normalize}.pkl")
-        elif kernel == 'linear':
-            save_path = os.path.join(self.dest_Gram, f"Gram_{kernel}_norm_{normalize}.pkl")
-        else:
-            raise ValueError
+        save_path = self.Gram_path(kernel, normalize, **kwargs)
         
-        if os.path.exists(save_path):
+        if utils_.cache_hit(save_path, **self.Gram_cache(kernel, normalize, **kwargs)):
             
             Gram_dict = utils_.load(save_path, verbose=False)
             
         else:
             
-            self.Sort_dict = self.calculation_Sort_dict(self.used_unit_types)
+            Sort_dict = self.load_Sort_dict()     # basic types
             
             def _calculation_Gram(layer, normalize, **kwargs):
                 
-                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), normalize=normalize, verbose=False, **kwargs)     # (500, num_samples)
-                feature = np.mean(feature.reshape(self.num_classes, self.num_samples, -1), axis=1)     # (50, num_samples)
+                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), normalize=normalize, mmap=True, verbose=False, **kwargs)     # (500, num_samples)
                 
-                # --- 
-                if kernel == 'linear':
-                    gram = utils_similarity.gram_linear
-                elif kernel =='rbf':
-                    gram = utils_similarity.gram_rbf
-                    
-                # ---
-                pl = Parallel(n_jobs=int(os.cpu_count()/2))(delayed(gram)(feature[:, self.Sort_dict[layer][k].astype(int)], **kwargs) for k in self.used_unit_types)
-
-                metric_type_dict = {k: pl[idx] for idx, k in enumerate(self.used_unit_types)}
-
-                return metric_type_dict
+                return self.calculation_Gram_layer(feature, Sort_dict[layer], kernel, **kwargs)
             
             utils_.formatted_print(f'Calculating NN_unit_Gram of {self.model_structure}...')
             
             Gram_dict = {_:_calculation_Gram(_, normalize, **kwargs) for _ in tqdm(self.layers, desc='NN Gram')}
         
-            utils_.dump(Gram_dict, save_path)
+            self.save_Gram(Gram_dict, kernel, normalize, **kwargs)
             
         return Gram_dict
     
     
+    def Gram_path(self, kernel='linear', normalize=True, **kwargs) -> str:
+        
+        if kernel == 'rbf' and 'threshold' in kwargs:
+            return os.path.join(self.dest_Gram, f"Gram_{kernel}_{kwargs['threshold']}_norm_{normalize}.pkl")
+        elif kernel == 'linear':
+            return os.path.join(self.dest_Gram, f"Gram_{kernel}_norm_{normalize}.pkl")
+        else:
+            raise ValueError
+    
+    
+    def Gram_cache(self, kernel='linear', normalize=True, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the Gram results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'Gram',
+            'params': {'kernel': kernel, 'normalize': normalize, 'used_unit_types': list(self.used_unit_types), 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers), 
+                       **_cache_kwargs(kwargs, sort=True, select_ratio=0, threshold=None)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.Sort_dict_path]
+            }
+    
+    
+    def save_Gram(self, Gram_dict, kernel='linear', normalize=True, **kwargs) -> None:
+        
+        utils_.dump(Gram_dict, self.Gram_path(kernel, normalize, **kwargs), tool='pickle5')
+        utils_.cache_seal(self.Gram_path(kernel, normalize, **kwargs), **self.Gram_cache(kernel, normalize, **kwargs))
+    
+    
+    def calculation_Gram_layer(self, feature, sort_dict, kernel='linear', **kwargs) -> dict:
+        """
+            Gram of one loaded (500, num_units) layer for every used unit type, sort_dict is the basic Sort_dict of the 
+            layer: the linear Gram is computed once per disjoint basic type and every unit type is the sum of its basic 
+            types, the basic Grams are the streamed moments for both ndarray and Feature_Memmap
+        """
+        
+        if kernel not in ['linear', 'rbf']:
+            raise ValueError
+        
+        basic_types = sorted(set().union(*[self.unit_types_dict[k] for k in self.used_unit_types]))
+        
+        moments = calculation_unit_type_moments(feature, sort_dict, basic_types, self.num_classes, self.num_samples)
+        basic_Gram = {k: dot_products for k, (_, _, dot_products, _) in moments.items()}
+        
+        Gram_dict = self.calculation_unit_type_compose(basic_Gram, self.used_unit_types)
+        
+        if kernel == 'linear':
+            return {k: v.astype(feature.dtype) for k, v in Gram_dict.items()}
+        elif kernel == 'rbf':
+            return {k: utils_similarity.gram_rbf_from_linear(v, **kwargs).astype(feature.dtype) for k, v in Gram_dict.items()}
+    
+    
     def plot_Gram(self, ):
         """
             plot the Gram
@@ -18,9 +18,8 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from joblib import Parallel, delayed
+from scipy import sparse
 from scipy.interpolate import interp1d
-from collections import Counter
 
 #from scipy.stats import gaussian_kde
 #from matplotlib import gridspec
@@ -31,7 +30,7 @@ import utils_
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-__all__ = ["FSA_Encode", "FSA_Encode_folds", "FSA_Encode_Comparison"]
+__all__ = ["FSA_Encode", "FSA_Encode_folds", "FSA_Encode_Comparison", "Encode_Layer"]
 
 plt.rcParams.update({'font.size': 18})    
 plt.rcParams.update({"font.family": "Times New Roman"})
@@ -85,26 +84,26 @@ class FSA_Encode():
         return utils_.load(sort_dict_path, verbose=verbose, **kwargs)
         
     
-    def load_Encode_dict(self, encode_dict_path=None, verbose=False, **kwargs) -> np.ndarray:
+    def load_Encode_dict(self, encode_dict_path=None, verbose=False, **kwargs) -> dict:
+        """ {layer: Encode_Layer}, the legacy {layer: {unit_idx: {'encode', 'weak_encode'}}} file is converted """
         if encode_dict_path is None:
             encode_dict_path = os.path.join(self.dest_Encode, 'Encode_dict.pkl')
-        return utils_.load(encode_dict_path, verbose=verbose, **kwargs)
+        return {layer: Encode_Layer.from_state(v, num_classes=self.num_classes) for layer, v in utils_.load(encode_dict_path, verbose=verbose, **kwargs).items()}
     
     
-    def calculation_Encode(self, num_workers=-1, **kwargs):
+    def calculation_Encode(self, chunk_size=8192, **kwargs):
         """ 
             this function returns the sort_dict and encode_dict of every layer 
             
             sort_layer: {layer: [unit_indices]}
-            encode_dict: {layer: {unit_idx: encoded_idx}}
+            encode_dict: {layer: Encode_Layer}, saved as plain index+offsets arrays, see Encode_Layer.state()
+            
+            chunk_size: number of units processed together by calculation_Encode_batch()
         """
 
         utils_.formatted_print('Executing calculation_Encode...')
         
-        sort_dict_path = os.path.join(self.dest_Encode, 'Sort_dict.pkl')
-        encode_dict_path = os.path.join(self.dest_Encode, 'Encode_dict.pkl')
-
-        if os.path.exists(sort_dict_path) and os.path.exists(encode_dict_path):
+        if utils_.cache_hit(self.Encode_paths, **self.Encode_cache()):
             
             pass
         
@@ -114,63 +113,64 @@ class FSA_Encode():
             self.Encode_dict = {}
             self.Sort_dict = {}
             
-            self.ANOVA_indices = utils_.load(os.path.join(self.dest, 'ANOVA/ANOVA_indices.pkl'), verbose=True) 
+            self.ANOVA_indices = utils_.load(self.ANOVA_idces_path, verbose=True) 
             
             # --- running
-            for layer in self.layers:     # for each layer
+            for layer in tqdm(self.layers, desc='Encode'):     # for each layer
                 
                 feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), verbose=False, **kwargs)      # load feature matrix
                 
-                # ----- 1. ANOVA
-                a = self.ANOVA_indices[layer]     # anova_idx
-                na = np.setdiff1d(np.arange(feature.shape[1]), a)     # non_anova_idx
-                
-                # ----- 2. Encode
-                pl = Parallel(n_jobs=num_workers)(delayed(calculation_Encode)(feature[:, i]) for i in tqdm(range(feature.shape[1]), desc=f'[{layer}] Encode'))  
-                unit_encode_dict = {i: pl[i] for i in range(len(pl))}    
-                
-                self.Encode_dict[layer] = unit_encode_dict    
-                
-                # ----- 2. encode test
-                hs = []
-                ls = []
-                hm = []
-                lm = []
-                non_encode = []
-                
-                for k, v in unit_encode_dict.items():
-                    if len(v['encode']) == 1:
-                        hs.append(k)
-                    elif len(v['encode']) == 0 and len(v['weak_encode']) == 1:
-                        ls.append(k)
-                    elif len(v['encode']) > 1:
-                        hm.append(k)
-                    elif len(v['encode']) == 0 and len(v['weak_encode']) > 1:
-                        lm.append(k)
-                    elif len(v['encode']) == 0 and len(v['weak_encode']) == 0:
-                        non_encode.append(k)
+                self.Encode_dict[layer], self.Sort_dict[layer] = self.calculation_Encode_layer(feature, self.ANOVA_indices[layer], chunk_size=chunk_size)
                 
-                # ----- 3. basic types
-                unit_sort_dict = {
-                                'a_hs': np.intersect1d(a, hs),
-                                'a_ls': np.intersect1d(a, ls),
-                                'a_hm': np.intersect1d(a, hm),
-                                'a_lm': np.intersect1d(a, lm),
-                                'a_ne': np.intersect1d(a, non_encode),
-                                
-                                'na_hs': np.intersect1d(na, hs),
-                                'na_ls': np.intersect1d(na, ls),
-                                'na_hm': np.intersect1d(na, hm),
-                                'na_lm': np.intersect1d(na, lm),
-                                'na_ne': np.intersect1d(na, non_encode),
-                                }
-                
-                self.Sort_dict[layer] = unit_sort_dict
-                
-            utils_.dump(self.Sort_dict, sort_dict_path, verbose=True)
-            utils_.dump(self.Encode_dict, encode_dict_path, verbose=True)  
+            self.save_Encode()
             
-            utils_.formatted_print('Sort_dict and Encode_dict have been saved')
+    
+    @property
+    def Encode_paths(self) -> tuple:
+        return os.path.join(self.dest_Encode, 'Sort_dict.pkl'), os.path.join(self.dest_Encode, 'Encode_dict.pkl')
+    
+    
+    def Encode_cache(self, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the Encode results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'Encode',
+            'params': {'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.ANOVA_idces_path]
+            }
+    
+    
+    @property
+    def ANOVA_idces_path(self) -> str:
+        """ the same as FSA_ANOVA.ANOVA_paths[0] """
+        return os.path.join(self.dest, 'ANOVA', 'ANOVA_idces.pkl')
+    
+    
+    @property
+    def Sort_dict_path(self) -> str:
+        return self.Encode_paths[0]
+    
+    
+    def calculation_Encode_layer(self, feature, anova_indices, chunk_size=8192, **kwargs) -> tuple:
+        """ Encode of one loaded layer, returns (Encode_Layer, basic Sort_dict of the layer) """
+        
+        # ----- 1. Encode, (num_units, num_classes) CSR masks
+        encode, weak_encode = calculation_Encode_batch(feature, num_classes=self.num_classes, num_samples=self.num_samples, chunk_size=chunk_size)
+        
+        # ----- 2. basic types
+        return Encode_Layer(encode, weak_encode), calculation_Sort_dict_basic(encode, weak_encode, anova_indices)
+    
+    
+    def save_Encode(self, ):
+        
+        sort_dict_path, encode_dict_path = self.Encode_paths
+        
+        utils_.dump(self.Sort_dict, sort_dict_path, verbose=True)
+        utils_.dump({layer: v.state() for layer, v in self.Encode_dict.items()}, encode_dict_path, verbose=True)
+        
+        utils_.cache_seal(self.Encode_paths, **self.Encode_cache())  
+        
+        utils_.formatted_print('Sort_dict and Encode_dict have been saved')
             
     
     def calculation_Sort_dict(self, used_unit_types:list[str], **kwargs) -> dict:
@@ -179,8 +179,20 @@ class FSA_Encode():
         if not hasattr(self, 'Sort_dict'):
             self.Sort_dict = self.load_Sort_dict()
         
-        return {layer: {k: np.concatenate([sort_dict[__] for __ in self.unit_types_dict[k]]).astype(int) for k in used_unit_types} for layer, sort_dict in self.Sort_dict.items()}
+        return {layer: self.calculation_Sort_dict_layer(sort_dict, used_unit_types) for layer, sort_dict in self.Sort_dict.items()}
+    
+    
+    def calculation_Sort_dict_layer(self, sort_dict, used_unit_types:list[str], **kwargs) -> dict:
+        """ the same as calculation_Sort_dict() for the basic Sort_dict of one layer """
+        
+        return {k: np.concatenate([sort_dict[__] for __ in self.unit_types_dict[k]]).astype(int) for k in used_unit_types}
+        
+    
+    def calculation_unit_type_compose(self, basic_dict, used_unit_types:list[str], **kwargs) -> dict:
+        """ additive statistic (e.g. linear Gram, row sum) of every used unit type as the sum of its disjoint basic types """
         
+        return {k: sum(basic_dict[__] for __ in self.unit_types_dict[k]) for k in used_unit_types}
+    
     
     def calculation_units_pct(self, used_unit_types:list[str], **kwargs) -> dict:
         """ this function returns the pct of used types for every layer """
@@ -467,16 +479,7 @@ class FSA_Encode():
                 
                 for k, units in sort_dict.items():
 
-                    if units.size > 0:  
-                        if encode_type:=_encode_type_check(k):
-                            id_pool = np.concatenate([encode_dict[unit][encode_type] for unit in units])
-                        else:
-                            id_pool = np.concatenate([[*encode_dict[unit]['encode'], *encode_dict[unit]['weak_encode']] for unit in units])
-                    else:
-                        id_pool = np.array([])
-            
-                    frequency = Counter(id_pool)
-                    freq[k] = np.array([frequency[_]/self.units[idx]  for _ in range(self.num_classes)]) 
+                    freq[k] = encode_dict.freq(units, _encode_type_check(k))/self.units[idx]
            
                 freq_layer[layer] = freq
                 
@@ -860,3 +863,171 @@ def calculation_unit_responses(input, num_classes=50, num_samples=10, n=2, **kwa
 
     return local_means, global_mean, threshold, ref
 
+
+def calculation_Encode_batch(input, num_classes=50, num_samples=10, n=2, chunk_size=8192, **kwargs):
+    """
+        batched version of calculation_Encode() for all units of the (num_classes*num_samples, num_units) input
+        
+        return:
+            encode, weak_encode: (num_units, num_classes) boolean scipy.sparse.csr_matrix, the column indices of 
+        row i are the encoded ids of unit i
+    """
+    
+    num_units = input.shape[1]
+    
+    encode_rows, encode_cols = [], []
+    weak_encode_rows, weak_encode_cols = [], []
+    
+    for start in range(0, num_units, chunk_size):
+        
+        local_means, global_mean, threshold, ref = calculation_unit_responses_batch(input[:, start:start+chunk_size], num_classes=num_classes, num_samples=num_samples, n=n)
+        
+        encode = (local_means > threshold).T     # '>' prevent all 0, (chunk_size, num_classes)
+        weak_encode = (local_means > ref).T & ~encode
+        
+        for mask, rows, cols in ((encode, encode_rows, encode_cols), (weak_encode, weak_encode_rows, weak_encode_cols)):
+            r, c = np.nonzero(mask)     # row-major, the ids of every unit are sorted
+            rows.append(r + start)
+            cols.append(c)
+    
+    def _csr(rows, cols):
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_units))])
+        return sparse.csr_matrix((np.ones(cols.size, dtype=bool), cols, indptr), shape=(num_units, num_classes))
+    
+    return _csr(encode_rows, encode_cols), _csr(weak_encode_rows, weak_encode_cols)
+
+
+def calculation_unit_responses_batch(input, num_classes=50, num_samples=10, n=2, **kwargs):
+    """
+        batched version of calculation_unit_responses(), local_means is (num_classes, num_units), the others are 
+        (num_units,)
+    """
+    
+    input = np.asarray(input, dtype=np.float64)
+    
+    global_mean = np.mean(input, axis=0)
+    local_means = np.mean(input.reshape(num_classes, num_samples, -1), axis=1)
+    
+    threshold = global_mean + n*np.std(input, axis=0)     # total variance
+    ref = global_mean + n*np.std(local_means, axis=0)     # between-group variance
+    
+    return local_means, global_mean, threshold, ref
+
+
+def calculation_Sort_dict_basic(encode, weak_encode, anova_indices) -> dict:
+    """ this function bins all units into the 10 basic types by the number of (weak) encoded ids and ANOVA """
+    
+    num_encode = np.diff(encode.indptr)
+    num_weak_encode = np.diff(weak_encode.indptr)
+    
+    a = np.zeros(encode.shape[0], dtype=bool)
+    a[np.asarray(anova_indices, dtype=int)] = True
+    
+    encode_types = {
+        'hs': num_encode == 1,
+        'ls': (num_encode == 0) & (num_weak_encode == 1),
+        'hm': num_encode > 1,
+        'lm': (num_encode == 0) & (num_weak_encode > 1),
+        'ne': (num_encode == 0) & (num_weak_encode == 0),
+        }
+    
+    return {**{f'a_{k}': np.flatnonzero(a & v) for k, v in encode_types.items()}, 
+            **{f'na_{k}': np.flatnonzero(~a & v) for k, v in encode_types.items()}}
+
+
+class Encode_Layer():
+    """
+        columnar storage of the (weak) encoded ids of all units in one layer, one index+offsets (CSR) pair per encode 
+        type instead of one dict with 2 small arrays per unit
+        
+        ids of unit i: indices[indptr[i]:indptr[i+1]]
+    """
+    
+    encode_types = ('encode', 'weak_encode')
+    
+    def __init__(self, encode=None, weak_encode=None, num_classes=50, **kwargs):
+        """ encode, weak_encode: (num_units, num_classes) boolean CSR masks from calculation_Encode_batch() """
+        
+        self.num_classes = num_classes if encode is None else encode.shape[1]
+        self.indices, self.indptr = {}, {}
+        
+        for k, v in zip(self.encode_types, (encode, weak_encode)):
+            if v is not None:
+                self.indices[k] = v.indices.astype(_ids_dtype(self.num_classes))
+                self.indptr[k] = v.indptr.astype(np.int64)
+        
+    
+    @classmethod
+    def from_state(cls, state:dict, num_classes=50):
+        """ rebuild from state(), or convert the legacy {unit_idx: {'encode': ids, 'weak_encode': ids}} dict """
+        
+        encode_layer = cls(num_classes=state.get('num_classes', num_classes))
+        
+        if 'indptr' in state:
+            encode_layer.indices = {k: np.asarray(state['indices'][k]) for k in cls.encode_types}
+            encode_layer.indptr = {k: np.asarray(state['indptr'][k]) for k in cls.encode_types}
+        else:     # --- legacy
+            units = sorted(state.keys())
+            for k in cls.encode_types:
+                ids = [np.asarray(state[_][k]) for _ in units]
+                encode_layer.indptr[k] = np.concatenate([[0], np.cumsum([_.size for _ in ids])]).astype(np.int64)
+                encode_layer.indices[k] = (np.concatenate(ids) if ids else np.array([])).astype(_ids_dtype(encode_layer.num_classes))
+        
+        return encode_layer
+    
+    
+    def state(self) -> dict:
+        """ plain numpy arrays for the on-disk Encode_dict.pkl """
+        return {'num_classes': self.num_classes, 'indices': self.indices, 'indptr': self.indptr}
+    
+    
+    def __len__(self):
+        return self.indptr['encode'].size - 1
+    
+    
+    def __getitem__(self, unit) -> dict:
+        """ legacy access, encode_dict[unit]['encode'] """
+        return {k: self.ids(unit, k) for k in self.encode_types}
+    
+    
+    def ids(self, unit, encode_type='encode') -> np.ndarray:
+        indptr = self.indptr[encode_type]
+        return self.indices[encode_type][indptr[unit]:indptr[unit+1]].astype(np.int64)
+    
+    
+    def counts(self, encode_type='encode') -> np.ndarray:
+        """ number of (weak) encoded ids of every unit, (num_units,) """
+        return np.diff(self.indptr[encode_type])
+    
+    
+    def mask(self, encode_type='encode'):
+        """ (num_units, num_classes) boolean CSR mask """
+        indices = self.indices[encode_type]
+        return sparse.csr_matrix((np.ones(indices.size, dtype=bool), indices, self.indptr[encode_type]), shape=(len(self), self.num_classes))
+    
+    
+    def freq(self, units, encode_type=None) -> np.ndarray:
+        """ 
+            number of times every id is (weak) encoded by the given units, (num_classes,)
+            
+            encode_type: 'encode', 'weak_encode', or None for both
+        """
+        
+        units = np.asarray(units, dtype=np.int64)
+        freq = np.zeros(self.num_classes, dtype=np.int64)
+        
+        for k in ((encode_type,) if encode_type is not None else self.encode_types):
+            
+            indptr = self.indptr[k]
+            starts, lengths = indptr[units], indptr[units+1]-indptr[units]
+            
+            positions = np.repeat(starts-np.cumsum(lengths)+lengths, lengths) + np.arange(lengths.sum())     # flattened segments
+            freq += np.bincount(self.indices[k][positions], minlength=self.num_classes)
+        
+        return freq
+
+
+def _ids_dtype(num_classes):
+    return np.uint8 if num_classes <= np.iinfo(np.uint8).max + 1 else np.uint16 if num_classes <= np.iinfo(np.uint16).max + 1 else np.int64
+
@@ -39,6 +39,7 @@ from utils_ import utils_similarity
 
 from bio_records_process.monkey_feature_process import monkey_feature_process
 from bio_records_process.human_feature_process import human_feature_process
+from bio_records_process.primate_feature_process import Permuted_Stats
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -107,45 +108,26 @@ class RSA_Base():
             
             raise ValueError
         
-        if os.path.exists(save_path):
+        # --- the NN DSMs are the upstream input, the primate references are fixed by primate/used_unit_type/used_id_num
+        RSA_cache = {
+            'stage': 'RSA',
+            'params': {'first_corr': first_corr, 'second_corr': second_corr, 'primate': primate, 'used_unit_type': used_unit_type, 'used_id_num': used_id_num, 'alpha': alpha, 'FDR_method': FDR_method, 'layers': list(self.layers), 'kwargs': kwargs},
+            'inputs': [self.DSM_path(first_corr)]
+            }
+        
+        if utils_.cache_hit(save_path, **RSA_cache):
             
             RSA_dict = utils_.load(save_path, verbose=False)
             
         else:
             
-            def _calculation_RSA(_layer, _second_corr='spearman', **kwargs):    
-
-                # --- init, NN_DSM_v
-                NN_DM = _vectorize_check(self.NN_DM_dict[_layer])
-                
-                if np.isnan(NN_DM).all():
-                    NN_DM = np.full_like(self.primate_DM, np.nan)
-                
-                assert self.primate_DM.shape == NN_DM.shape
+            # --- primate references and NN DSMs are shared once, tasks receive only handles
+            with utils_.Shared_Arrays() as shared:
                 
-                # --- init, corr_func
-                corr_func = _corr(_second_corr)
+                primate_DMs = {_: shared.put(getattr(self, _)) for _ in ['primate_DM', 'primate_DM_perm', 'primate_DM_temporal', 'primate_DM_temporal_perm']}
+                NN_DMs = {layer: shared.put(np.asarray(self.NN_DM_dict[layer])) for layer in self.layers}
                 
-                # ----- static
-                corr_coef = calculation_RSA(corr_func, self.primate_DM, NN_DM)
-                corr_coef_perm = np.array([calculation_RSA(corr_func, _, NN_DM) for _ in self.primate_DM_perm])     # (1000,)
-                
-                # ----- temporal
-                corr_coef_temporal = calculation_RSA_temporal(corr_func, self.primate_DM_temporal, NN_DM)     # (time_steps, )
-                corr_coef_temporal_perm = np.array([calculation_RSA_temporal(corr_func, _, NN_DM) for _ in self.primate_DM_temporal_perm])     # (num_perm, time_steps)
-
-                return {
-                    'corr_coef': corr_coef,
-                    'corr_coef_perm': corr_coef_perm,
-                    'p_perm': np.mean(corr_coef_perm > corr_coef),     # equal to: np.sum(corr_coef_perm > corr_coef)/num_perm,
-                    
-                    'corr_coef_temporal': corr_coef_temporal,
-                    'corr_coef_temporal_perm': corr_coef_temporal_perm,
-                    'p_perm_temporal': np.array([np.mean(corr_coef_temporal_perm[:, _] > corr_coef_temporal[_]) for _ in range(len(corr_coef_temporal))])
-                    }
-            
-            # -----
-            pl = Parallel(n_jobs=int(os.cpu_count()/2))(delayed(_calculation_RSA)(layer, second_corr=second_corr, **kwargs) for layer in tqdm(self.layers, desc='RSA'))
+                pl = Parallel(n_jobs=utils_.get_num_workers(int(os.cpu_count()/2)))(delayed(calculation_RSA_layer)(NN_DMs[layer], second_corr=second_corr, **primate_DMs, **kwargs) for layer in tqdm(self.layers, desc='RSA'))
 
             # -----
             pl_k = ['corr_coef', 'corr_coef_perm', 'p_perm', 'corr_coef_temporal', 'corr_coef_temporal_perm', 'p_perm_temporal']
@@ -185,6 +167,7 @@ class RSA_Base():
                 }
             
             utils_.dump(RSA_dict, save_path, verbose=False)
+            utils_.cache_seal(save_path, **RSA_cache)
         
         return RSA_dict
     
@@ -265,8 +248,8 @@ class RSA_Monkey(monkey_feature_process, FSA_DSM, RSA_Base):
         
         self.primate_DM = _vectorize_check(self.primate_DM)
         self.primate_DM_temporal = np.array([_vectorize_check(_) for _ in self.primate_DM_temporal])
-        self.primate_DM_perm = np.array([_vectorize_check(_) for _ in self.primate_DM_perm])
-        self.primate_DM_temporal_perm = np.array([np.array([_vectorize_check(__) for __ in _]) for _ in self.primate_DM_temporal_perm])
+        self.primate_DM_perm = _vectorize_perm_check(self.primate_DM_perm)
+        self.primate_DM_temporal_perm = _vectorize_perm_check(self.primate_DM_temporal_perm)
         
         # --- NN init
         self.NN_DM_dict = {k:v['qualified'] for k,v in self.calculation_DSM(first_corr, vectorize=False, **kwargs).items()}   # layer - cell_type
@@ -427,8 +410,8 @@ class RSA_Human(human_feature_process, FSA_DSM, RSA_Base):
         self.primate_DM = _vectorize_check(DM)
         self.primate_DM_temporal = np.array([_vectorize_check(_) for _ in DM_temporal])
         
-        self.primate_DM_perm = np.array([_vectorize_check(_) for _ in DM_perm])
-        self.primate_DM_temporal_perm = np.array([np.array([_vectorize_check(__) for __ in _]) for _ in DM_temporal_perm])
+        self.primate_DM_perm = _vectorize_perm_check(DM_perm)
+        self.primate_DM_temporal_perm = _vectorize_perm_check(DM_temporal_perm)
         
         # --- RSA calculation
         RSA_dict = self.calculation_RSA(first_corr=first_corr, second_corr=second_corr, used_unit_type=used_unit_type, used_id_num=used_id_num, primate='Human', **kwargs)
@@ -519,6 +502,120 @@ def calculation_RSA_temporal(corr_func, primate_DM_temporal, NN_DM, **kwargs):
     return np.array([calculation_RSA(corr_func, _, NN_DM, **kwargs) for _ in primate_DM_temporal])      # (time_steps, )
 
 
+def calculation_RSA_layer(NN_DM, primate_DM, primate_DM_perm, primate_DM_temporal, primate_DM_temporal_perm, second_corr='spearman', **kwargs):
+    """
+        RSA of one layer with the permutation test, arrays can be passed as utils_.Shared_Handle
+        
+        input shape: NN - (corr_matrix) or (corr_vector, ); Bio - (corr_vector, ), (num_perm, corr_vector), 
+                     (time_steps, corr_vector), (num_perm, time_steps, corr_vector)
+    """
+    
+    NN_DM, primate_DM, primate_DM_perm, primate_DM_temporal, primate_DM_temporal_perm = [utils_.shared_load(_) for _ in (NN_DM, primate_DM, primate_DM_perm, primate_DM_temporal, primate_DM_temporal_perm)]
+    
+    # --- init, NN_DSM_v
+    NN_DM = _vectorize_check(NN_DM)
+    
+    if np.isnan(NN_DM).all():
+        NN_DM = np.full_like(primate_DM, np.nan)
+    
+    assert primate_DM.shape == NN_DM.shape
+    
+    # ----- static
+    corr_coef = calculation_RSA_batch(second_corr, primate_DM, NN_DM)[()]
+    corr_coef_perm = calculation_RSA_batch(second_corr, primate_DM_perm, NN_DM)     # (1000,)
+    
+    # ----- temporal
+    corr_coef_temporal = calculation_RSA_batch(second_corr, primate_DM_temporal, NN_DM)     # (time_steps, )
+    corr_coef_temporal_perm = calculation_RSA_batch(second_corr, primate_DM_temporal_perm, NN_DM)     # (num_perm, time_steps)
+
+    return {
+        'corr_coef': corr_coef,
+        'corr_coef_perm': corr_coef_perm,
+        'p_perm': np.mean(corr_coef_perm > corr_coef),     # equal to: np.sum(corr_coef_perm > corr_coef)/num_perm,
+        
+        'corr_coef_temporal': corr_coef_temporal,
+        'corr_coef_temporal_perm': corr_coef_temporal_perm,
+        'p_perm_temporal': np.array([np.mean(corr_coef_temporal_perm[:, _] > corr_coef_temporal[_]) for _ in range(len(corr_coef_temporal))])
+        }
+
+
+def calculation_RSA_batch(second_corr, primate_DMs, NN_DM, chunk_size=4096, **kwargs):
+    """
+        batched second-order correlation, all rows of primate_DMs are correlated with the same NN_DM, the NN_DM is 
+        ranked/centered once and every chunk of rows reduces to one matrix-vector product
+        
+        input shape: Bio - (..., corr_vector), e.g. (corr_vector,), (time_steps, corr_vector), (num_perm, corr_vector), 
+                     (num_perm, time_steps, corr_vector); NN - (corr_vector, )
+        return: (...), the same values as calculation_RSA() of every row
+    """
+    
+    primate_DMs = np.asarray(primate_DMs)
+    NN_DM = np.asarray(NN_DM)
+    
+    if second_corr not in ['spearman', 'pearson', 'concordance']:
+        raise ValueError('[Coderror] invalid second_corr')
+    
+    assert primate_DMs.shape[-1] == NN_DM.shape[-1]
+    
+    batch_shape = primate_DMs.shape[:-1]
+    primate_DMs = primate_DMs.reshape(-1, NN_DM.shape[-1])     # (num_rows, corr_vector)
+    
+    # --- NN_DM with nan or constant values, the same as _spearmanr/_pearson/_ccc
+    if np.unique(NN_DM).size < 2 or np.any(np.isnan(NN_DM)):
+        return np.full(batch_shape, np.nan)
+    
+    y = scipy.stats.rankdata(NN_DM) if second_corr == 'spearman' else NN_DM.astype(np.float64)
+    y = y - np.mean(y)
+    
+    corr_coef = np.concatenate([_batch_corr(second_corr, primate_DMs[_:_+chunk_size], y, NN_DM) for _ in range(0, primate_DMs.shape[0], chunk_size)]) if primate_DMs.size else np.empty(0)
+    
+    return corr_coef.reshape(batch_shape)
+
+
+def _batch_corr(second_corr, X, y, NN_DM):
+    """
+        X: (num_rows, corr_vector), primate
+        y: (corr_vector,), centered NN_DM (ranks for spearman)
+    """
+    
+    X = X.astype(np.float64)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+    
+        if second_corr == 'spearman':
+            
+            nan_rows = np.isnan(X).any(axis=1)
+            
+            R = scipy.stats.rankdata(np.where(nan_rows[:, None], 0., X), axis=1)
+            R -= R.mean(axis=1, keepdims=True)
+            
+            corr_coef = np.clip((R @ y)/(np.sqrt(np.einsum('ij,ij->i', R, R))*np.sqrt(y @ y)), -1., 1.)
+            
+            # --- nan_policy='omit' ranks the remaining pairs of each row, rare, fall back to the per-row calculation
+            if nan_rows.any():
+                corr_coef[nan_rows] = [_spearmanr(_, NN_DM) for _ in X[nan_rows]]
+        
+        else:
+        
+            X_mean = X.mean(axis=1, keepdims=True)
+            Xc = X - X_mean
+            
+            cov = Xc @ y     # (num_rows,), sum of products
+            X_ss = np.einsum('ij,ij->i', Xc, Xc)
+            
+            if second_corr == 'pearson':
+                
+                corr_coef = np.clip(cov/(np.sqrt(X_ss)*np.sqrt(y @ y)), -1., 1.)
+                
+            elif second_corr == 'concordance':
+                
+                n = X.shape[1]
+                corr_coef = 2*(cov/n)/(X_ss/n + (y @ y)/n + (X_mean[:, 0] - np.mean(NN_DM))**2)
+                corr_coef[X_ss == 0] = np.nan     # constant row, corrcoef -> nan
+    
+    return corr_coef
+
+
 def plot_RSA(ax, similarity, similarity_std=None, similarity_mask=None, similarity_perm=None, color=None, smooth=True, used_unit_types=None, **kwargs):
     
     # -- init
@@ -617,6 +714,18 @@ def _vectorize_check(input:np.ndarray):
     return input
 
 
+def _vectorize_perm_check(input):
+    """ the same as _vectorize_check() of every permuted (temporal) matrix, gathered directly for lazy Permuted_Stats """
+    
+    if isinstance(input, Permuted_Stats) and not np.isnan(input.stats).all(axis=(-2, -1)).any():
+        return input.vectorize()
+    
+    if np.ndim(input) == 3:
+        return np.array([_vectorize_check(_) for _ in input])
+    else:
+        return np.array([np.array([_vectorize_check(__) for __ in _]) for _ in input])
+
+
 def _corr(second_corr):
     
     corr_func_map = {
@@ -51,7 +51,8 @@ class FSA_Responses(FSA_Encode):
         self.dest_Responses = os.path.join(self.dest_Encode, 'Responses')
         utils_.make_dir(self.dest_Responses)
         
-        self.Sort_dict = self.load_Sort_dict(**kwargs)
+        if os.path.exists(self.Encode_paths[0]):     # <- not yet calculated in layer-major mode
+            self.Sort_dict = self.load_Sort_dict(**kwargs)
         
         ...
     
@@ -61,11 +62,11 @@ class FSA_Responses(FSA_Encode):
         self.dest_Intensity = os.path.join(self.dest_Responses, 'Intensity')
         utils_.make_dir(self.dest_Intensity)
         
-        save_path = os.path.join(self.dest_Intensity, 'Intensity.pkl')
+        save_path = self.Intensity_path
         save_path_units_pct = os.path.join(self.dest_Intensity, 'units_pct.pkl')
         
         # ---
-        if os.path.exists(save_path):
+        if utils_.cache_hit(save_path, **self.Intensity_cache(used_unit_types)):
             
             Intensity_dict = utils_.load(save_path)
             
@@ -74,48 +75,18 @@ class FSA_Responses(FSA_Encode):
             def _single_layer_process(layer, sort_dict):
                 
                 feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), verbose=False)
-                feature = np.mean(feature.reshape(self.num_classes, self.num_samples, -1), axis=1)     # (50, num_samples)
                 
-                mean = {}
-                std = {}
-                log_mean = {}
-                log_std = {}
-                zero_pct = {}
-                
-                for k, v in sort_dict.items():
-                
-                    subfeature = feature[:, v]    
-                
-                    mean[k] = np.mean(subfeature)
-                    std[k] =np.std(subfeature)
-                    log_mean[k] = np.mean(np.log(subfeature[subfeature!=0])/np.log(10))
-                    log_std[k] = np.std(np.log(subfeature[subfeature!=0])/np.log(10))
-                    zero_pct[k] = np.sum(subfeature==0)/subfeature.size*100
-                
-                I_dict = {
-                    'mean': mean,
-                    'std': std,
-                    'log_mean': log_mean,
-                    'log_std': log_std,
-                    'zero_pct': zero_pct
-                    }
-                
-                return I_dict
+                return calculation_Feature_Intensity_layer(feature, sort_dict, num_classes=self.num_classes, num_samples=self.num_samples)
         
             self.Sort_dict = self.load_Sort_dict()
             Sort_dict = self.calculation_Sort_dict(used_unit_types, **kwargs)
             
-            Intensity_dict = {}
-            
-            pl = Parallel(n_jobs=15)(delayed(_single_layer_process)(layer, Sort_dict[layer]) for layer in self.layers)
-            
-            Intensity_dict = {k: pl[idx] for idx, k in enumerate(self.layers)}
-            Intensity_dict = {k: {__: [Intensity_dict[_][__][k] for _ in self.layers] for __ in ['mean', 'std', 'log_mean', 'log_std', 'zero_pct']} for k in used_unit_types}
+            pl = Parallel(n_jobs=utils_.get_num_workers(15))(delayed(_single_layer_process)(layer, Sort_dict[layer]) for layer in self.layers)
             
-            utils_.dump(Intensity_dict, save_path)
+            Intensity_dict = self.save_Feature_Intensity({k: pl[idx] for idx, k in enumerate(self.layers)}, used_unit_types)
             
         # ---
-        if os.path.exists(save_path_units_pct):
+        if utils_.cache_hit(save_path_units_pct, **(units_pct_cache:={'stage': 'units_pct', 'params': {'used_unit_types': list(used_unit_types)}, 'inputs': [self.Sort_dict_path]})):
             
             units_pct = utils_.load(save_path_units_pct)
             
@@ -123,9 +94,39 @@ class FSA_Responses(FSA_Encode):
             
             units_pct = self.calculation_units_pct(used_unit_types, **kwargs)
             utils_.dump(units_pct, save_path_units_pct)
+            utils_.cache_seal(save_path_units_pct, **units_pct_cache)
             
         return Intensity_dict, units_pct
     
+    
+    @property
+    def Intensity_path(self) -> str:
+        return os.path.join(self.dest_Responses, 'Intensity', 'Intensity.pkl')
+    
+    
+    def Intensity_cache(self, used_unit_types, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the Intensity results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'Intensity',
+            'params': {'used_unit_types': list(used_unit_types), 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.Sort_dict_path]
+            }
+    
+    
+    def save_Feature_Intensity(self, Intensity_dict, used_unit_types, **kwargs) -> dict:
+        """ {layer: {stat: {unit_type: value}}} -> {unit_type: {stat: [value of each layer]}} """
+        
+        utils_.make_dir(os.path.dirname(self.Intensity_path))
+        
+        Intensity_dict = {k: {__: [Intensity_dict[_][__][k] for _ in self.layers] for __ in ['mean', 'std', 'log_mean', 'log_std', 'zero_pct']} for k in used_unit_types}
+        
+        utils_.dump(Intensity_dict, self.Intensity_path)
+        utils_.cache_seal(self.Intensity_path, **self.Intensity_cache(used_unit_types))
+        
+        return Intensity_dict
+    
+    
     @staticmethod
     def plot_Feature_Intensity_single(ax, layers, Intensity_dict, used_unit_type, units_pct, direction='horizontal'):
         
@@ -244,10 +245,10 @@ class FSA_Responses(FSA_Encode):
         for layer in self.layers[start_layer_idx:]:
              
             utils_.make_dir(layer_fig_folder:=os.path.join(fig_folder, f'{layer}'))
-            feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), normalize=True, sort=True, verbose=False, **kwargs)
+            feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), normalize=True, sort=True, mmap=True, verbose=False, **kwargs)
             
-            vmin = np.min(feature)
-            vmax = np.max(feature)
+            vmin = feature.min()
+            vmax = feature.max()
             
             for cell_type, v  in tqdm(self.Sort_dict[layer].items(), desc=f'{layer}'):     # for each type
                 
@@ -328,7 +329,7 @@ class FSA_Responses(FSA_Encode):
                 #warnings.simplefilter(action='ignore')
                 #logging.getLogger('matplotlib').setLevel(logging.ERROR)
                 
-                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), verbose=False, **kwargs)[:, Sort_dict[layer][unit_type]]
+                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), mmap=True, verbose=False, **kwargs)[:, Sort_dict[layer][unit_type]]
                 
                 fig = human_feature_process.plot_PDF(self.model_structure, 'unit', feature, unit_type=unit_type, **kwargs)
                 
@@ -492,6 +493,38 @@ def calculation_unit_responses(input, num_classes=50, num_samples=10, n=2, **kwa
     return local_means, global_mean, threshold, ref
 
 
+def calculation_Feature_Intensity_layer(feature, sort_dict, num_classes=50, num_samples=10, **kwargs) -> dict:
+    """ intensity statistics of one loaded (500, num_units) layer for every unit type of the given sort_dict """
+    
+    feature = np.mean(feature.reshape(num_classes, num_samples, -1), axis=1)     # (50, num_samples)
+    
+    mean = {}
+    std = {}
+    log_mean = {}
+    log_std = {}
+    zero_pct = {}
+    
+    for k, v in sort_dict.items():
+    
+        subfeature = feature[:, v]    
+    
+        mean[k] = np.mean(subfeature)
+        std[k] =np.std(subfeature)
+        log_mean[k] = np.mean(np.log(subfeature[subfeature!=0])/np.log(10))
+        log_std[k] = np.std(np.log(subfeature[subfeature!=0])/np.log(10))
+        zero_pct[k] = np.sum(subfeature==0)/subfeature.size*100
+    
+    I_dict = {
+        'mean': mean,
+        'std': std,
+        'log_mean': log_mean,
+        'log_std': log_std,
+        'zero_pct': zero_pct
+        }
+    
+    return I_dict
+
+
 
 class FSA_Responses_folds(FSA_Responses):
 
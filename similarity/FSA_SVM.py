@@ -28,11 +28,19 @@ plt.rcParams.update({"font.family": "Times New Roman"})
 
 # ----------------------------------------------------------------------------------------------------------------------
 class FSA_SVM(FSA_Encode):
-    """ the default SVM kernel is RBF """
+    """
+        the default SVM kernel is RBF
+        
+        SVM_kernel: 'rbf' or 'linear', the precomputed kernel of the sample Gram
+        cv_folds: None - one train/test split as the legacy results, int - stratified k-fold, folds run in parallel
+    """
     
-    def __init__(self, **kwargs):
+    def __init__(self, SVM_kernel='rbf', cv_folds=None, **kwargs):
         
         super().__init__(**kwargs)
+        
+        self.SVM_kernel = SVM_kernel
+        self.cv_folds = cv_folds
 
         self.dest_SVM = os.path.join(self.dest, 'SVM')
         utils_.make_dir(self.dest_SVM)
@@ -55,6 +63,24 @@ class FSA_SVM(FSA_Encode):
         plt.close()
     
     
+    def process_Ridge(self, **kwargs):
+        """ decoding curves of the linear Ridge decoder, one figure per regularization value """
+        
+        # ----- calculation
+        Ridge_results = self.calculation_Ridge(**kwargs)
+        
+        # ----- plot
+        for idx, alpha in enumerate(Ridge_results['alphas']):
+            
+            fig, ax = plt.subplots(figsize=(10,6))
+            
+            self.plot_SVM(ax, {k: v[:, idx] for k, v in Ridge_results.items() if k != 'alphas'}, **kwargs)
+            
+            ax.set_title(title:=f'Ridge {self.model_structure} alpha={alpha:g}')
+            fig.savefig(os.path.join(self.dest_SVM, f'{title}.svg'), bbox_inches='tight')
+            plt.close()
+    
+    
     def calculation_SVM(self, used_unit_types=None, **kwargs):
         """
             ...
@@ -66,31 +92,154 @@ class FSA_SVM(FSA_Encode):
             
             used_unit_types = self.basic_types_display + self.advanced_types_display + ['a_s', 'a_m']
             
-        if os.path.exists(SVM_path:=os.path.join(self.dest_SVM, f'SVM {self.model_structure}.pkl')):
+        if utils_.cache_hit(self.SVM_path, **self.SVM_cache(used_unit_types)):
             
-            SVM_results = utils_.load(SVM_path)
+            SVM_results = utils_.load(self.SVM_path)
             
         else:
             
             # --- init
-            self.Sort_dict = self.load_Sort_dict()
-            Sort_dict = self.calculation_Sort_dict(used_unit_types)
+            self.Sort_dict = self.load_Sort_dict()     # basic types
             
             SVM_results = {}
             
             for layer in tqdm(self.layers, desc=f'SVM {self.model_structure}'):
                 
                 # --- depends
-                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), verbose=False, **kwargs)
+                feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), mmap=True, verbose=False, **kwargs)
 
                 # ---
-                SVM_results[layer] = {k: calculation_SVM(feature[:, v], np.repeat(np.arange(self.num_classes), self.num_samples)) for k,v in Sort_dict[layer].items()}
-            
-            SVM_results = {_: np.array([v[_] for k,v in SVM_results.items()]) for _ in used_unit_types}
+                SVM_results[layer] = self.calculation_SVM_layer(feature, self.Sort_dict[layer], used_unit_types)
             
-            utils_.dump(SVM_results, SVM_path, verbose=False)
+            SVM_results = self.save_SVM(SVM_results, used_unit_types)
 
         return SVM_results
+    
+    
+    @property
+    def SVM_path(self) -> str:
+        
+        if self.SVM_kernel == 'rbf' and self.cv_folds is None:
+            return os.path.join(self.dest_SVM, f'SVM {self.model_structure}.pkl')
+        else:
+            return os.path.join(self.dest_SVM, f'SVM {self.model_structure} {self.SVM_kernel} cv{self.cv_folds}.pkl')
+    
+    
+    def SVM_cache(self, used_unit_types, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the SVM results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'SVM',
+            'params': {'kernel': self.SVM_kernel, 'cv_folds': self.cv_folds, 'used_unit_types': list(used_unit_types), 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.Sort_dict_path]
+            }
+    
+    
+    def calculation_SVM_layer(self, feature, sort_dict, used_unit_types, **kwargs) -> dict:
+        """ SVM of one loaded layer for every used unit type, sort_dict is the basic Sort_dict of the layer """
+        
+        gram, row_sum, num_units = self.calculation_sample_Gram_layer(feature, sort_dict, used_unit_types)
+        
+        label = np.repeat(np.arange(self.num_classes), self.num_samples)
+        
+        return {k: calculation_SVM_Gram(gram[k], row_sum[k], num_units[k], label, kernel=self.SVM_kernel, num_folds=self.cv_folds) for k in used_unit_types}
+    
+    
+    def calculation_sample_Gram_layer(self, feature, sort_dict, used_unit_types, **kwargs) -> tuple:
+        """
+            the sample Gram is computed once per disjoint basic type and every unit type is the sum of its basic types
+            
+            return: {unit_type: (500, 500) X·Xᵀ}, {unit_type: (500,) row sum}, {unit_type: num_units}
+        """
+        
+        basic_types = sorted(set().union(*[self.unit_types_dict[k] for k in used_unit_types]))
+        
+        basic_Gram = {k: calculation_sample_Gram(feature, sort_dict[k]) for k in basic_types}
+        
+        gram = self.calculation_unit_type_compose({k: v[0] for k, v in basic_Gram.items()}, used_unit_types)
+        row_sum = self.calculation_unit_type_compose({k: v[1] for k, v in basic_Gram.items()}, used_unit_types)
+        num_units = self.calculation_unit_type_compose({k: sort_dict[k].size for k in basic_types}, used_unit_types)
+        
+        return gram, row_sum, num_units
+    
+    
+    def calculation_Ridge(self, used_unit_types=None, alphas=(1e-3, 1e-2, 1e-1, 1., 10.), num_folds=5, **kwargs) -> dict:
+        """
+            linear decoding by the dual kernel ridge classifier, fast enough to sweep the regularization of all layers 
+            and unit types, see utils_.ridge_classification_Gram()
+            
+            return: {unit_type: (num_layers, num_alphas)}, {'alphas': alphas} is also saved
+        """
+        
+        utils_.formatted_print(f'computing Ridge {self.model_structure}...')
+        
+        if used_unit_types == None:
+            
+            used_unit_types = self.basic_types_display + self.advanced_types_display + ['a_s', 'a_m']
+        
+        if utils_.cache_hit(self.Ridge_path(num_folds), **self.Ridge_cache(used_unit_types, alphas, num_folds, **kwargs)):
+            
+            return utils_.load(self.Ridge_path(num_folds), verbose=False)
+        
+        # --- init
+        Sort_dict = self.load_Sort_dict()     # basic types
+        
+        Ridge_results = {}
+        
+        for layer in tqdm(self.layers, desc=f'Ridge {self.model_structure}'):
+            
+            feature = utils_.load_feature(os.path.join(self.root, f'{layer}.pkl'), mmap=True, verbose=False, **kwargs)
+            
+            Ridge_results[layer] = self.calculation_Ridge_layer(feature, Sort_dict[layer], used_unit_types, alphas, num_folds)
+        
+        return self.save_Ridge(Ridge_results, used_unit_types, alphas, num_folds, **kwargs)
+    
+    
+    def calculation_Ridge_layer(self, feature, sort_dict, used_unit_types, alphas=(1e-3, 1e-2, 1e-1, 1., 10.), num_folds=5, **kwargs) -> dict:
+        """ Ridge of one loaded layer for every used unit type, sort_dict is the basic Sort_dict of the layer """
+        
+        gram, _, _ = self.calculation_sample_Gram_layer(feature, sort_dict, used_unit_types)
+        
+        label = np.repeat(np.arange(self.num_classes), self.num_samples)
+        
+        return {k: utils_.ridge_classification_Gram(gram[k], label, alphas=alphas, num_folds=num_folds) for k in used_unit_types}
+    
+    
+    def Ridge_path(self, num_folds=5) -> str:
+        return os.path.join(self.dest_SVM, f'Ridge {self.model_structure} cv{num_folds}.pkl')
+    
+    
+    def Ridge_cache(self, used_unit_types, alphas=(1e-3, 1e-2, 1e-1, 1., 10.), num_folds=5, **kwargs) -> dict:
+        """ stage, parameters and upstream inputs of the Ridge results, see utils_.cache_hit() """
+        
+        return {
+            'stage': 'Ridge',
+            'params': {'alphas': [float(_) for _ in alphas], 'num_folds': num_folds, 'used_unit_types': list(used_unit_types), 'normalize': kwargs.get('normalize', True), 'sort': kwargs.get('sort', True), 'num_classes': self.num_classes, 'num_samples': self.num_samples, 'layers': list(self.layers)},
+            'inputs': utils_.feature_inputs(self.root, self.layers) + [self.Sort_dict_path]
+            }
+    
+    
+    def save_Ridge(self, Ridge_results, used_unit_types, alphas=(1e-3, 1e-2, 1e-1, 1., 10.), num_folds=5, **kwargs) -> dict:
+        """ {layer: {unit_type: (num_alphas,)}} -> {unit_type: (num_layers, num_alphas)}, {'alphas': alphas} """
+        
+        Ridge_results = {_: np.array([v[_] for k,v in Ridge_results.items()]) for _ in used_unit_types}
+        Ridge_results['alphas'] = np.array(alphas)
+        
+        utils_.dump(Ridge_results, self.Ridge_path(num_folds), verbose=False)
+        utils_.cache_seal(self.Ridge_path(num_folds), **self.Ridge_cache(used_unit_types, alphas, num_folds, **kwargs))
+        
+        return Ridge_results
+    
+    
+    def save_SVM(self, SVM_results, used_unit_types, **kwargs) -> dict:
+        """ {layer: {unit_type: acc}} -> {unit_type: (num_layers,)} """
+        
+        SVM_results = {_: np.array([v[_] for k,v in SVM_results.items()]) for _ in used_unit_types}
+        
+        utils_.dump(SVM_results, self.SVM_path, verbose=False)
+        utils_.cache_seal(self.SVM_path, **self.SVM_cache(used_unit_types))
+        
+        return SVM_results
             
     
     def plot_SVM(self, ax, SVM_results, color=None, label=None, ncol=2, smooth=True, text=False, **kwargs):
@@ -143,6 +292,30 @@ def calculation_SVM(input, label, **kwargs):
     return utils_.SVM_classification(input, label, test_size=0.2, random_state=42, **kwargs) if input.size != 0 else 0.
 
 
+def calculation_SVM_Gram(gram, row_sum, num_features, label, **kwargs):
+    """ the same as calculation_SVM() from the additive statistics of the input, see calculation_sample_Gram() """
+    
+    return utils_.SVM_classification_Gram(gram, row_sum, num_features, label, test_size=0.2, random_state=42, **kwargs)
+
+
+def calculation_sample_Gram(feature, units, chunk_size=65536, **kwargs) -> tuple:
+    """ (num_samples, num_samples) X·Xᵀ and (num_samples,) row sum of X = feature[:, units], accumulated over unit chunks in float64 """
+    
+    units = np.sort(np.asarray(units).astype(int))
+    
+    gram = np.zeros((feature.shape[0], feature.shape[0]))
+    row_sum = np.zeros(feature.shape[0])
+    
+    for start in range(0, units.size, chunk_size):
+        
+        X = np.asarray(feature[:, units[start:start+chunk_size]], dtype=np.float64)
+        
+        gram += X @ X.T
+        row_sum += X.sum(axis=1)
+    
+    return gram, row_sum
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class FSA_SVM_folds(FSA_SVM):
     """
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:21:04 2026
+
+@author: acxyle
+
+    equivalence of the streaming pearson DSM and the in-memory DSM_calculation()
+
+"""
+
+import os
+import importlib.util
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+
+
+def _load_utils_similarity():
+    """ load the module file only, utils_/__init__.py requires torch and spikingjelly """
+    
+    spec = importlib.util.spec_from_file_location('utils_similarity', os.path.join(os.path.dirname(__file__), '..', 'utils_', 'utils_similarity.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    
+    return module
+
+
+utils_similarity = _load_utils_similarity()
+
+
+@pytest.mark.parametrize('vectorize', [False, True])
+def test_DSM_pearson_from_moments_zero_variance_row(vectorize):
+    
+    rng = np.random.default_rng(0)
+    
+    feature = rng.random((50, 300))     # (num_classes, num_units)
+    feature[4] = 0.     # e.g. all-zero class mean of a unit type
+    feature[7] = 0.
+    
+    DSM = utils_similarity.DSM_calculation(feature, 'pearson', vectorize=vectorize)
+    DSM_moments = utils_similarity.DSM_pearson_from_moments(feature.shape[1], feature.sum(1), feature @ feature.T, vectorize=vectorize)
+    
+    assert not np.isnan(DSM_moments).any()
+    np.testing.assert_allclose(DSM_moments, DSM, atol=1e-6)
@@ -78,6 +78,9 @@ def training_strategy_parser(parser):
     parser.add_argument("--val_crop_size", default=224, type=int, help="the central crop size used for validation")
     parser.add_argument("--train_crop_size", default=176, type=int, help="the random crop size used for training")
     
+    parser.add_argument("--preprocessed_cache", default=None, type=str, help="directory of the preprocessed eval images, see training_utils.Preprocessed_Dataset")
+    parser.add_argument("--preprocessed_dtype", default="uint8", type=str, help="uint8 (before normalize) or float16 (after normalize)")
+    
     parser.add_argument("--seed", default=2020, type=int, help="the random seed")
 
     parser.add_argument("--disable_pinmemory", action="store_true", help="not use pin memory in dataloader")
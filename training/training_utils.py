@@ -16,8 +16,11 @@ Created on Fri Sep 27 04:13:27 2023
 
 # --- python
 import os
+import json
 import random
+import hashlib
 import numpy as np
+from tqdm import tqdm
 
 # --- pytorch
 import torch
@@ -62,6 +65,9 @@ def prepare_datasets_tv(args, verbose=False):
                                                                         interpolation=interpolation
                                                                                                 ),
                                                     )
+    
+    if getattr(args, 'preprocessed_cache', None) is not None:
+        dataset_test = Preprocessed_Dataset(valdir, dataset_test.transform, args.preprocessed_cache, dtype=args.preprocessed_dtype)
         
     if verbose:
         print(dataset)
@@ -78,6 +84,10 @@ def prepare_datasets_cls(args, split_ratio=0.8, verbose=False, shuffle=True):
                                                             crop_size=args.val_crop_size, 
                                                             interpolation=InterpolationMode(args.interpolation)
                                                                                         ),)
+    
+    if getattr(args, 'preprocessed_cache', None) is not None:     # --- the eval transform is deterministic
+        dataset = Preprocessed_Dataset(args.data_path, dataset.transform, args.preprocessed_cache, dtype=args.preprocessed_dtype)
+    
     if shuffle:
         dataset_train, dataset_val = random_split(dataset, [split_ratio, 1 - split_ratio])
     else:
@@ -91,6 +101,126 @@ def prepare_datasets_cls(args, split_ratio=0.8, verbose=False, shuffle=True):
     return dataset_train, dataset_val
 
 
+class Preprocessed_Dataset(torch.utils.data.Dataset):
+    """
+        ImageFolder with a deterministic (eval) transform, the images are decoded and transformed once into a 
+        memory-mapped (num_images, C, H, W) tensor file + labels under cache_dir, later runs (e.g. extraction sweeps over 
+        checkpoints) read the samples from the page cache without decoding
+        
+        dtype:
+            - 'uint8': the transforms up to PILToTensor are cached, ConvertImageDtype/Normalize are applied on read
+            - 'float16': the whole transform is cached
+        
+        the cache is keyed by the root, the transform and the (path, size, mtime) of every image, and rebuilt if any 
+        of them changes
+    """
+    
+    def __init__(self, root, transform, cache_dir, dtype='uint8', verbose=True, **kwargs):
+        
+        assert dtype in ['uint8', 'float16'], f"Invalid dtype: {dtype}. Choose from 'uint8', 'float16'."
+        
+        folder = torchvision.datasets.ImageFolder(root=root)
+        
+        self.root = root
+        self.classes = folder.classes
+        self.class_to_idx = folder.class_to_idx
+        self.samples = folder.samples
+        self.targets = folder.targets
+        
+        self.transform = transform
+        self.dtype = dtype
+        
+        # --- split the preset into the cached part and the part applied on read
+        _transforms = transform.transforms.transforms if hasattr(transform, 'transforms') and hasattr(transform.transforms, 'transforms') else transform.transforms
+        
+        if dtype == 'uint8':
+            split = next(i for i, _ in enumerate(_transforms) if isinstance(_, torchvision.transforms.PILToTensor))+1
+            self.cached_transform = torchvision.transforms.Compose(_transforms[:split])
+            self.read_transform = torchvision.transforms.Compose(_transforms[split:])
+        else:
+            self.cached_transform = torchvision.transforms.Compose(_transforms)
+            self.read_transform = None
+        
+        # --- cache key
+        content = {
+            'root': os.path.realpath(root),
+            'transform': repr(self.cached_transform),
+            'dtype': dtype,
+            'samples': [(os.path.relpath(path, root), target, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path, target in self.samples]
+            }
+        
+        key = hashlib.sha1(json.dumps(content).encode()).hexdigest()[:16]
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        self.images_path = os.path.join(cache_dir, f'{os.path.basename(os.path.normpath(root))}_{key}_images.npy')
+        self.targets_path = os.path.join(cache_dir, f'{os.path.basename(os.path.normpath(root))}_{key}_targets.npy')
+        
+        if not (os.path.exists(self.images_path) and os.path.exists(self.targets_path)):
+            self.build(verbose=verbose)
+        
+        self.images = np.load(self.images_path, mmap_mode='c')     # copy-on-write, writable views without touching the file
+        self.labels = np.load(self.targets_path)
+        
+    
+    def build(self, verbose=True):
+        """ decode and transform every image once, written to a temporary file and renamed on complete """
+        
+        images = None
+        tmp_path = f'{self.images_path}.{os.getpid()}.tmp.npy'
+        
+        try:
+            
+            for idx, (path, target) in tqdm(enumerate(self.samples), desc='Preprocessing', total=len(self.samples), disable=not verbose):
+                
+                image = self.cached_transform(torchvision.datasets.folder.default_loader(path))
+                
+                if images is None:
+                    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(self.dtype), shape=(len(self.samples), *image.shape))
+                
+                images[idx] = image.numpy()
+            
+            images.flush()
+            del images
+            
+            os.replace(tmp_path, self.images_path)
+            np.save(self.targets_path, np.asarray(self.targets, dtype=np.int64))
+            
+        finally:
+            
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        
+    
+    def __len__(self):
+        return len(self.samples)
+    
+    
+    def __getitem__(self, idx):
+        
+        image = torch.from_numpy(self.images[idx])     # view of the memmap
+        
+        if self.read_transform is not None:
+            image = self.read_transform(image)
+        else:
+            image = image.float()
+        
+        return image, int(self.labels[idx])
+    
+    
+    def __getitems__(self, indices):
+        """ batched read for torch.utils.data.DataLoader, one memmap read for a contiguous batch """
+        
+        if len(indices) and np.all(np.diff(indices) == 1):
+            images = torch.from_numpy(self.images[indices[0]:indices[-1]+1])
+        else:
+            images = torch.from_numpy(self.images[indices])
+        
+        images = self.read_transform(images) if self.read_transform is not None else images.float()     # (batch_size, C, H, W)
+        
+        return list(zip(images, self.labels[indices].tolist()))
+    
+    
 def get_dataloader_single(args, dataset, num_workers=1):
     
     dataloader = torch.utils.data.DataLoader(dataset, 
@@ -1,6 +1,10 @@
 #from ._legacy import *
 #from ._bio_cells import *
 from ._load import *
+from ._feature_store import *
+from ._spike_store import *
+from ._shared import *
+from ._cache import *
 from ._plot import *
 from ._layers_info import *
 
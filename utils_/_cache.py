@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 19:05:27 2026
+
+@author: acxyle
+
+    content-addressed result cache: every saved result has a '{save_path}.meta.json' sidecar recording the key, a hash
+    of the stage name, the parameters and the fingerprints (size, mtime) of the upstream input files, a result is only
+    reused if the key of the current call is the same, otherwise it is recomputed and overwritten
+
+    e.g.
+        if utils_.cache_hit(save_path, 'DSM', params, inputs):
+            DSM_dict = utils_.load(save_path)
+        else:
+            ...
+            utils_.dump(DSM_dict, save_path)
+            utils_.cache_seal(save_path, 'DSM', params, inputs)
+
+    results saved without sidecar (earlier versions) are treated as stale
+
+"""
+
+import os
+import json
+import hashlib
+
+
+__all__ = [
+    'fingerprint', 'cache_key', 'cache_hit', 'cache_seal', 'cache_evict', 'feature_inputs'
+    ]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def fingerprint(file_path) -> str:
+    """ 'size:mtime_ns' of the file, the layer '.pkl' resolves as load_feature(): feature store '.npy', legacy pickle, spike store, None if missing """
+
+    for path in [f'{os.path.splitext(file_path)[0]}.npy', file_path, f'{os.path.splitext(file_path)[0]}_spikes/meta.json'] if file_path.endswith('.pkl') else [file_path]:
+
+        if os.path.isfile(path):
+
+            stat = os.stat(path)
+
+            return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+    return None
+
+
+def feature_inputs(root, layers) -> list:
+    return [os.path.join(root, f'{layer}.pkl') for layer in layers]
+
+
+def cache_key(stage, params=None, inputs=(), **kwargs) -> str:
+
+    content = {
+        'stage': stage,
+        'params': params if params is not None else {},
+        'inputs': {os.path.realpath(_): fingerprint(_) for _ in inputs}
+        }
+
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def _meta_path(save_path):
+    return f'{save_path}.meta.json'
+
+
+def _save_paths(save_paths):
+    return [save_paths] if isinstance(save_paths, str) else list(save_paths)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def cache_hit(save_paths, stage, params=None, inputs=(), **kwargs) -> bool:
+    """ True if all save_paths exist and were sealed with the same key, save_paths: one path or a list of paths """
+
+    key = cache_key(stage, params, inputs)
+
+    for save_path in _save_paths(save_paths):
+
+        if not (os.path.exists(save_path) and os.path.exists(meta_path:=_meta_path(save_path))):
+            return False
+
+        try:
+            with open(meta_path, 'r') as f:
+                if json.load(f).get('key') != key:
+                    return False
+        except (OSError, ValueError):
+            return False
+
+    return True
+
+
+def cache_seal(save_paths, stage, params=None, inputs=(), **kwargs) -> str:
+    """ write the sidecars after the results have been saved, returns the key """
+
+    key = cache_key(stage, params, inputs)
+
+    meta = {
+        'stage': stage,
+        'key': key,
+        'params': json.loads(json.dumps(params if params is not None else {}, sort_keys=True, default=repr)),
+        'inputs': {os.path.realpath(_): fingerprint(_) for _ in inputs}
+        }
+
+    for save_path in _save_paths(save_paths):
+
+        with open(_meta_path(save_path), 'w') as f:
+            json.dump(meta, f, indent=5)
+
+    return key
+
+
+def cache_evict(root, dry_run=False, verbose=True, **kwargs) -> list:
+    """ remove the results under root whose recorded upstream inputs have changed or disappeared """
+
+    evicted = []
+
+    for dir_path, _, file_names in os.walk(root):
+
+        for file_name in file_names:
+
+            if not file_name.endswith('.meta.json'):
+                continue
+
+            meta_path = os.path.join(dir_path, file_name)
+            save_path = meta_path[:-len('.meta.json')]
+
+            try:
+                with open(meta_path, 'r') as f:
+                    inputs = json.load(f).get('inputs', {})
+            except (OSError, ValueError):
+                inputs = None
+
+            if inputs is None or any(fingerprint(k) != v for k, v in inputs.items()):
+
+                evicted.append(save_path)
+
+                if not dry_run:
+                    for path in [save_path, meta_path]:
+                        if os.path.exists(path):
+                            os.remove(path)
+
+                if verbose:
+                    print(f'stale result {save_path} {"found" if dry_run else "evicted"}')
+
+    return evicted
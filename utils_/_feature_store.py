@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:40 2026
+
+@author: acxyle
+
+    feature store: one raw .npy file per layer + one .json metadata sidecar, replaces the per-layer pickles in
+    'Features/', the .npy is saved column-major (fortran order) so the (num_samples,) column of every unit is contiguous
+    on disk and column subsets can be read lazily through np.memmap
+
+    the extraction writes batches of rows, which would touch every page of a column-major file, so a layer written batch
+    by batch is staged as row-major '{layer}.staging.npy' and transposed into the store by column chunks when sealed
+
+"""
+
+import os
+import json
+import numpy as np
+
+
+__all__ = [
+    'dump_feature', 'load_feature_meta', 'feature_store_path', 'open_feature', 'seal_feature',
+    'Feature_Memmap'
+    ]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def feature_store_path(file_path):
+    """ 'Features/{layer}.pkl' or 'Features/{layer}' -> ('Features/{layer}.npy', 'Features/{layer}.json') """
+
+    root = os.path.splitext(file_path)[0] if os.path.splitext(file_path)[-1] in ['.pkl', '.pickle', '.npy', '.json'] else file_path
+
+    return f'{root}.npy', f'{root}.json'
+
+
+def dump_feature(feature, file_path, num_classes=50, num_samples=10, verbose=False, **kwargs):
+    """
+        save one layer as the feature store format
+
+        feature: (num_classes*num_samples, num_units) in the lexicographic order of the dataset (pytorch)
+        kwargs: additional metadata, must be json serializable
+    """
+
+    npy_path, meta_path = feature_store_path(file_path)
+
+    if os.path.exists(npy_path) and verbose:
+        print(f'path {npy_path} exists, OVERWRITING...')
+
+    feature = np.asarray(feature)
+
+    fp = open_feature(npy_path, feature.shape, feature.dtype)
+    fp[...] = feature
+    fp.flush()
+    del fp
+
+    return _write_feature_meta(meta_path, feature.shape, feature.dtype, num_classes, num_samples,
+                               np.min(feature).item() if feature.size else None, np.max(feature).item() if feature.size else None, **kwargs)
+
+
+def _staging_path(npy_path) -> str:
+    return f'{os.path.splitext(npy_path)[0]}.staging.npy'
+
+
+def open_feature(file_path, shape, dtype=np.float32, staging=False, **kwargs) -> np.memmap:
+    """ 
+        create one empty layer of the feature store as writable np.memmap, filled by the caller then seal_feature() 
+        
+        staging: row-major staging file for writes by rows (batches of samples)
+    """
+
+    npy_path, _ = feature_store_path(file_path)
+
+    if staging:
+        return np.lib.format.open_memmap(_staging_path(npy_path), mode='w+', dtype=dtype, shape=tuple(shape), fortran_order=False)
+
+    return np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=tuple(shape), fortran_order=True)
+
+
+def seal_feature(fp, file_path, num_classes=50, num_samples=10, chunk_size=65536, max_bytes=2**28, **kwargs):
+    """ 
+        flush the layer created by open_feature() and write its metadata, min/max by a chunked column scan, a staged 
+        layer is copied into the column-major store by the same scan (blocks of at most max_bytes) and removed
+    """
+
+    npy_path, meta_path = feature_store_path(file_path)
+
+    fp.flush()
+
+    staged = os.path.realpath(fp.filename) == os.path.realpath(_staging_path(npy_path))
+    out = open_feature(npy_path, fp.shape, fp.dtype) if staged else fp
+
+    chunk_size = max(1, min(chunk_size, max_bytes//max(1, fp.shape[0]*fp.dtype.itemsize)))
+
+    _min, _max = None, None
+
+    for start in range(0, fp.shape[1], chunk_size):
+        block = np.asarray(fp[:, start:start+chunk_size])
+        if staged:
+            out[:, start:start+chunk_size] = block
+        if block.size:
+            _min = np.min(block) if _min is None else min(_min, np.min(block))
+            _max = np.max(block) if _max is None else max(_max, np.max(block))
+
+    if staged:
+        out.flush()
+        del out
+        os.remove(fp.filename)
+
+    return _write_feature_meta(meta_path, fp.shape, fp.dtype, num_classes, num_samples,
+                               _min.item() if _min is not None else None, _max.item() if _max is not None else None, **kwargs)
+
+
+def _write_feature_meta(meta_path, shape, dtype, num_classes, num_samples, _min, _max, **kwargs):
+
+    meta = {
+        'shape': list(shape),
+        'dtype': np.dtype(dtype).str,
+        'num_classes': num_classes,
+        'num_samples': num_samples,
+        'order': 'lexicographic',
+        'min': _min,
+        'max': _max,
+        **kwargs
+        }
+
+    _dump_feature_meta(meta_path, meta)
+
+    return meta
+
+
+def _dump_feature_meta(meta_path, meta) -> None:
+    """ temp file + os.replace(), concurrent readers never see a truncated metadata """
+
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=5)
+
+    os.replace(tmp_path, meta_path)
+
+
+def load_feature_meta(file_path):
+
+    _, meta_path = feature_store_path(file_path)
+
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class Feature_Memmap():
+    """
+        memmap-backed view of one layer of the feature store, nothing is read from disk until it is indexed
+
+        the normalize/sort semantics of load_feature() are applied lazily on the indexed block:
+            sort: rows are reordered from lexicographic order into natural order
+            normalize: min-max of the entire layer, computed once by a chunked scan
+            counts: uint8 spike counts are returned as they are, otherwise as firing rates counts/T if not normalize
+
+        e.g. feature[:, units] only reads the columns of the given units
+    """
+
+    def __init__(self, file_path, normalize=True, sort=True, num_classes=50, num_samples=10, chunk_size=65536, counts=False, **kwargs):
+
+        npy_path, meta_path = feature_store_path(file_path)
+
+        self.data = np.load(npy_path, mmap_mode='r')
+        assert self.data.ndim == 2, f'expected (num_samples, num_units) feature, got {self.data.shape}'
+
+        self.normalize = normalize
+        self.sort = sort
+        self.num_classes = num_classes
+        self.num_samples = num_samples
+        self.chunk_size = chunk_size
+
+        self._perm = None
+        
+        if sort:
+            
+            from ._load import restore_order_permutation
+            
+            self._perm = restore_order_permutation(self.data.shape[0], num_classes, num_samples)
+            
+            if self._perm is None:
+                raise ValueError(f'[Coderror] can not restore the order of {self.data.shape[0]} rows with num_classes={num_classes} and num_samples={num_samples}')
+        
+        self.meta_path = meta_path
+        self.meta = load_feature_meta(npy_path) if os.path.exists(meta_path) else {}
+        
+        self._min_max = (self.data.dtype.type(self.meta['min']), self.data.dtype.type(self.meta['max'])) if (self.meta.get('min') is not None and self.meta.get('max') is not None) else None
+        
+        # --- spike counts: T of the firing rates, None if returned as they are
+        self.T = self.meta['T'] if self.meta.get('encoding') == 'spike_count' and not counts else None
+        
+        if self.meta.get('encoding') == 'spike_count' and counts:
+            self.normalize = False
+
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def size(self):
+        return self.data.size
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32) if (self.normalize or self.T is not None) else self.data.dtype
+
+    def __len__(self):
+        return self.data.shape[0]
+
+
+    @property
+    def min_max(self) -> tuple:
+        """ 
+            (min, max) of the raw layer, from the metadata or a chunked scan which is then written back to the metadata, 
+            (0, 0) for an empty layer which is not written back as seal_feature()
+        """
+
+        if self._min_max is None:
+
+            _min, _max = None, None
+
+            for start in range(0, self.data.shape[1], self.chunk_size):
+                block = np.asarray(self.data[:, start:start+self.chunk_size])
+                if block.size:
+                    _min = np.min(block) if _min is None else min(_min, np.min(block))
+                    _max = np.max(block) if _max is None else max(_max, np.max(block))
+
+            if _min is None:
+                return (self.data.dtype.type(0), self.data.dtype.type(0))
+
+            self._min_max = (_min, _max)
+
+            if self.meta:
+                self.meta.update({'min': _min.item(), 'max': _max.item()})
+                _dump_feature_meta(self.meta_path, self.meta)
+
+        return self._min_max
+
+
+    def min(self):
+        _min, _max = self.min_max
+        return np.float32(0.) if self.normalize else (np.float32(_min)/self.T if self.T is not None else _min)
+
+    def max(self):
+        _min, _max = self.min_max
+        return np.float32((_max-_min)/(_max-_min)) if self.normalize else (np.float32(_max)/self.T if self.T is not None else _max)
+
+
+    def __getitem__(self, key) -> np.ndarray:
+
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+
+        block = np.asarray(self.data[:, cols])     # <- the only disk read
+
+        if self.sort:
+            block = block[self._perm]
+
+        block = block[rows]
+
+        if self.normalize:
+            _min, _max = self.min_max
+            block = (block.astype(np.float32)-_min)/(_max-_min)
+        elif self.T is not None:
+            block = block.astype(np.float32)/self.T
+
+        return block
+
+
+    def columns(self, units) -> np.ndarray:
+        return self[:, units]
+
+
+    def __array__(self, dtype=None, copy=None):
+        feature = self[:, :]
+        return feature if dtype is None else feature.astype(dtype)
+
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
@@ -8,38 +8,51 @@ Created on Fri Apr 14 22:07:14 2024
 
 
 import pickle
+import functools
 import gzip
 import joblib
 import json
+import threading
+import struct
+import zlib
+import bz2
+import lzma
 
 import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
+from collections import OrderedDict
+
 from tqdm import tqdm
 
 
 __all__ = [
     'dump', 'load', 'load_feature',
-    'restore_order', 'lexicographic_order'
+    'Feature_Cache', 'set_feature_cache', 'clear_feature_cache', 'feature_cache_info',
+    'restore_order', 'restore_order_permutation', 'lexicographic_order'
     ]
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # FIXME --- test version, create a visible progress bar for loading and saving (with problems)
 class tqdm_file_object:
-    def __init__(self, file_path, mode='rb', verbose=True, estimated_size=None):
+    def __init__(self, file_path, mode='rb', verbose=True, estimated_size=None, desc=None):
         self.file = open(file_path, mode)
         self.mode = mode
         self.verbose = verbose
+        
+        desc = file_path if desc is None else desc
 
         # init progress bar
         if 'r' in mode:
             self.length = os.fstat(self.file.fileno()).st_size
             if self.verbose:
-                self.tqdm = tqdm(total=self.length, unit='B', unit_scale=True, desc=f'Loading {file_path}')
+                self.tqdm = tqdm(total=self.length, unit='B', unit_scale=True, desc=f'Loading {desc}')
         elif 'w' in mode or 'a' in mode:
             if self.verbose:
-                self.tqdm = tqdm(total=estimated_size, unit='B', unit_scale=True, desc=f'Saving {file_path}')
+                self.tqdm = tqdm(total=estimated_size, unit='B', unit_scale=True, desc=f'Saving {desc}')
 
 
     def read(self, size=-1):
@@ -56,22 +69,36 @@ class tqdm_file_object:
             self.tqdm.update(len(data))
         return data
 
+    def readinto(self, buffer):
+        size = self.file.readinto(buffer)
+        if self.verbose:
+            self.tqdm.update(size)
+        return size
+
     def write(self, data):
         if 'w' not in self.mode and 'a' not in self.mode:
             raise NotImplementedError("write() not implemented on file opened in read mode")
         
-        if isinstance(data, pickle.PickleBuffer):     # PickleBuffer, for writing
-            data = bytes(data)
+        if isinstance(data, pickle.PickleBuffer):     # PickleBuffer, for writing, no copy
+            data = data.raw()
         
-        self.file.write(data)
+        size = self.file.write(data)
         if self.verbose:
-            self.tqdm.update(len(data))
-            self.tqdm.refresh()    # Refresh the progress bar display
-        os.fsync(self.file.fileno())    # Ensure data is written to disk
+            self.tqdm.update(size)
+        return size
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
 
     def close(self):
         if self.verbose:
             self.tqdm.close()
+        if 'r' not in self.mode:
+            self.file.flush()
+            os.fsync(self.file.fileno())    # once, when all data has been written
         self.file.close()
 
     def __enter__(self):
@@ -83,6 +110,15 @@ class tqdm_file_object:
 
 # ----------------------------------------------------------------------------------------------------------------------
 def dump(file, file_path, cmd='wb', tool='pickle', protocol=-1, verbose=True, **kwargs):
+    """
+        tool:
+            - 'pickle': single pass, written to a temporary file and renamed on complete
+            - 'pickle5': see _dump_pickle5(), numpy buffers are written out-of-band and optionally compressed by threads, 
+                         kwargs: compress (None, 'zlib', 'bz2', 'lzma'), level, chunk_size, num_threads
+            - 'gzip', 'joblib', 'json'
+        
+        the files of 'pickle' and 'pickle5' are both loaded by load(file_path)
+    """
     
     assert cmd in ['w', 'wb', 'w+', 'wb+']
     
@@ -105,11 +141,17 @@ def dump(file, file_path, cmd='wb', tool='pickle', protocol=-1, verbose=True, **
         
         assert os.path.splitext(file_path)[-1] in ['.pkl', '.pickle']
         
-        estimated_size = len(pickle.dumps(file, protocol=protocol))
-        
-        with tqdm_file_object(file_path, cmd, verbose, estimated_size=estimated_size) as f:
+        with _atomic_write(file_path) as tmp_path, tqdm_file_object(tmp_path, cmd, verbose, desc=file_path) as f:
             
             pickle.dump(file, f, protocol=protocol)
+    
+    elif tool == 'pickle5':
+        
+        assert os.path.splitext(file_path)[-1] in ['.pkl', '.pickle']
+        
+        with _atomic_write(file_path) as tmp_path:
+            
+            _dump_pickle5(file, tmp_path, verbose=verbose, desc=file_path, **kwargs)
           
     elif tool == 'json':
         
@@ -121,7 +163,7 @@ def dump(file, file_path, cmd='wb', tool='pickle', protocol=-1, verbose=True, **
 
     else:
 
-        raise ValueError(f"Invalid tool: {tool}. Choose from 'pickle', 'gzip', 'joblib', 'json'.")
+        raise ValueError(f"Invalid tool: {tool}. Choose from 'pickle', 'pickle5', 'gzip', 'joblib', 'json'.")
 
 
 
@@ -138,10 +180,13 @@ def load(file_path, cmd='rb', tool='pickle', verbose=True, **kwargs):
         with gzip.open(file_path, cmd) as f:
             loaded_file = pickle.load(f)
         
-    elif tool == 'pickle':
+    elif tool in ['pickle', 'pickle5']:
         assert os.path.splitext(file_path)[-1] in ['.pkl', '.pickle']
-        with tqdm_file_object(file_path, cmd, verbose) as f:
-            loaded_file = pickle.load(f)
+        if _is_pickle5(file_path):
+            loaded_file = _load_pickle5(file_path, verbose=verbose, **kwargs)
+        else:
+            with tqdm_file_object(file_path, cmd, verbose) as f:
+                loaded_file = pickle.load(f)
         
     elif tool == 'joblib':
         assert os.path.splitext(file_path)[-1] in ['.pkl', '.pickle', '.joblib']
@@ -153,43 +198,401 @@ def load(file_path, cmd='rb', tool='pickle', verbose=True, **kwargs):
             loaded_file = json.load(f)
 
     else:
-        raise ValueError(f"Invalid tool: {tool}. Choose from 'pickle', 'gzip', 'joblib', 'json'.")
+        raise ValueError(f"Invalid tool: {tool}. Choose from 'pickle', 'pickle5', 'gzip', 'joblib', 'json'.")
     
     return loaded_file
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+class _atomic_write:
+    """ yields a temporary path next to file_path, renamed onto file_path only if the block completes """
+    
+    def __init__(self, file_path):
+        
+        self.file_path = file_path
+        self.tmp_path = os.path.join(os.path.dirname(os.path.abspath(file_path)), f'.{os.path.basename(file_path)}.{os.getpid()}.tmp')
+    
+    def __enter__(self):
+        return self.tmp_path
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        if exc_type is not None:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            return False
+        
+        os.replace(self.tmp_path, self.file_path)
+        
+        try:     # persist the rename, not available on every platform
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+
+# ---
+#   pickle5 file: | magic | pickle stream | buffer chunks... | json index | uint64 index size |
+#   the pickle stream is protocol 5 with the (numpy) buffers taken out-of-band, every buffer is split into chunks of 
+#   chunk_size bytes and each chunk is stored raw or compressed
+_PICKLE5_MAGIC = b'FSAPK5\x00\x01'
+
+_compressors = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress, 1),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 1),
+    }
+
+
+def _is_pickle5(file_path) -> bool:
+    
+    with open(file_path, 'rb') as f:
+        return f.read(len(_PICKLE5_MAGIC)) == _PICKLE5_MAGIC
+
+
+def _dump_pickle5(file, file_path, compress=None, level=None, chunk_size=64*2**20, num_threads=None, verbose=True, desc=None, **kwargs):
+    """
+        serialize once with pickle protocol 5, buffers are written without copy if compress is None, otherwise the 
+        chunks are compressed by a thread pool (zlib, bz2 and lzma release the GIL) in bounded batches
+    """
+    
+    if compress is not None and compress not in _compressors:
+        raise ValueError(f"Invalid compress: {compress}. Choose from None, {', '.join(_compressors.keys())}.")
+    
+    buffers = []
+    stream = pickle.dumps(file, protocol=5, buffer_callback=buffers.append)
+    buffers = [_.raw() for _ in buffers]     # flat byte views
+    
+    estimated_size = len(stream) + sum(_.nbytes for _ in buffers)
+    num_threads = num_threads if num_threads is not None else min(8, os.cpu_count() or 1)
+    
+    index = {'compress': compress, 'pickle': len(stream), 'buffers': []}
+    
+    with tqdm_file_object(file_path, 'wb', verbose, estimated_size=None if compress else estimated_size, desc=desc) as f:
+        
+        f.write(_PICKLE5_MAGIC)
+        f.write(stream)
+        
+        if compress is None:
+            
+            for buffer in buffers:
+                f.write(buffer)
+                index['buffers'].append([[buffer.nbytes, buffer.nbytes]])     # [[stored_size, raw_size], ...]
+            
+        else:
+            
+            _compress, _, default_level = _compressors[compress]
+            level = default_level if level is None else level
+            
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                
+                for buffer in buffers:
+                    
+                    chunks = [buffer[_:_+chunk_size] for _ in range(0, buffer.nbytes, chunk_size)]
+                    chunk_sizes = []
+                    
+                    for start in range(0, len(chunks), 2*num_threads):
+                        
+                        batch = chunks[start:start+2*num_threads]
+                        
+                        for chunk, stored in zip(batch, executor.map(_compress, batch, [level]*len(batch))):
+                            f.write(stored)
+                            chunk_sizes.append([len(stored), chunk.nbytes])
+                        
+                    index['buffers'].append(chunk_sizes)
+        
+        index = json.dumps(index).encode()
+        
+        f.write(index)
+        f.write(struct.pack('<Q', len(index)))
+
+
+def _load_pickle5(file_path, num_threads=None, verbose=True, **kwargs):
+    """ buffers are read into writable bytearrays, so the loaded numpy arrays are writable as before """
+    
+    num_threads = num_threads if num_threads is not None else min(8, os.cpu_count() or 1)
+    
+    with tqdm_file_object(file_path, 'rb', verbose) as f:
+        
+        f.seek(-8, os.SEEK_END)
+        index_size = struct.unpack('<Q', f.file.read(8))[0]
+        f.seek(-8-index_size, os.SEEK_END)
+        index = json.loads(f.file.read(index_size))
+        
+        f.seek(len(_PICKLE5_MAGIC))
+        stream = f.read(index['pickle'])
+        
+        buffers = []
+        
+        if index['compress'] is None:
+            
+            for (stored_size, raw_size), in index['buffers']:
+                buffer = bytearray(raw_size)
+                f.readinto(buffer)
+                buffers.append(buffer)
+            
+        else:
+            
+            _, _decompress, _ = _compressors[index['compress']]
+            
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                
+                for chunk_sizes in index['buffers']:
+                    
+                    buffer = bytearray(sum(_[1] for _ in chunk_sizes))
+                    view = memoryview(buffer)
+                    offset = 0
+                    
+                    for start in range(0, len(chunk_sizes), 2*num_threads):
+                        
+                        batch = chunk_sizes[start:start+2*num_threads]
+                        
+                        for (stored_size, raw_size), chunk in zip(batch, executor.map(_decompress, [f.read(_[0]) for _ in batch])):
+                            assert len(chunk) == raw_size, f'[Coderror] corrupted chunk in {file_path}'
+                            view[offset:offset+raw_size] = chunk
+                            offset += raw_size
+                    
+                    buffers.append(buffer)
+    
+    return pickle.loads(stream, buffers=buffers)
+
+
 # -----
-def load_feature(file_path, normalize=True, sort=True, num_classes=50, num_samples=10, **kwargs):
+def load_feature(file_path, normalize=True, sort=True, num_classes=50, num_samples=10, mmap=False, counts=False, **kwargs):
     """
         ...
+        
+        mmap: return a utils_.Feature_Memmap view of the feature store ('{layer}.npy' + '{layer}.json'), columns are 
+              read lazily and normalize/sort are applied on the indexed block only, ignored for legacy pickles
+        
+        the feature store is preferred over a legacy '{layer}.pkl' of the same layer, the legacy pickle is only loaded if 
+        no feature store of the layer exists, if neither exists the firing rates
+        are decoded from the spike store '{layer}_spikes/' (the last int(T*select_ratio) time steps, 0 for all), if 
+        select_ratio or t_range is given and the cumulative counts '{layer}_cumulative.npy' exist, the firing rates of 
+        the time window are derived from them
+        
+        counts: for SNN layers saved as uint8 spike counts (metadata 'encoding': 'spike_count'), return the counts 
+                as they are, otherwise float32 firing rates counts/T are produced on load, the min-max normalization 
+                of counts and of firing rates are the same
+        
+        the reorder is one fancy-index copy with the cached permutation and the min-max scaling is applied in place on 
+        that copy, the layer min/max is taken from the feature store metadata if recorded
+        
+        if utils_.set_feature_cache() is enabled, the returned feature is shared and read-only
     """
     
-    feature = load(file_path, **kwargs)
+    from ._feature_store import feature_store_path, load_feature_meta, Feature_Memmap
+    from ._spike_store import spike_store_path, Spike_Store, cumulative_counts_path, Cumulative_Counts
+    
+    npy_path, meta_path = feature_store_path(file_path)
+    
+    if (kwargs.get('select_ratio', 0) or kwargs.get('t_range') is not None) and os.path.exists(cumulative_path:=cumulative_counts_path(file_path)):
+        
+        file_path = npy_path = cumulative_path     # time window
+    
+    elif not (os.path.exists(npy_path) or os.path.exists(file_path)) and os.path.isdir(spikes_path:=spike_store_path(file_path)):
+        
+        file_path = spikes_path
+    
+    if mmap and os.path.exists(npy_path) and npy_path != file_path:
+        
+        return Feature_Memmap(npy_path, normalize=normalize, sort=sort, num_classes=num_classes, num_samples=num_samples, counts=counts, **kwargs)
+    
+    use_store = os.path.exists(npy_path) and npy_path != file_path     # as mmap, the feature store wins over a stale legacy pickle
+    
+    # --- process-wide cache, shared by all analyzers
+    if _feature_cache.max_bytes > 0:
+        
+        source = npy_path if use_store else file_path
+        key = (os.path.realpath(source), os.stat(source).st_mtime_ns, normalize, sort, num_classes, num_samples, counts, kwargs.get('select_ratio', 0), kwargs.get('t_range'))
+        
+        if (feature:=_feature_cache.get(key)) is not None:
+            return feature
+        
+    meta = {}
+    
+    if use_store:
+        
+        feature = np.load(npy_path)
+        
+        if os.path.exists(meta_path):
+            meta = load_feature_meta(npy_path)
+    
+    elif os.path.isdir(file_path) or file_path.endswith('_cumulative.npy'):
+        
+        spike_store = Spike_Store(file_path) if os.path.isdir(file_path) else Cumulative_Counts(file_path)
+        feature = spike_store.counts(**kwargs) if counts else spike_store.firing_rates(**kwargs)     # (500, num_units)
+        meta = {'encoding': 'spike_count', 'T': spike_store.T} if counts else {}
+        
+    else:
+        
+        feature = load(file_path, **kwargs)
+    
+    if sort and (perm:=restore_order_permutation(feature.shape[0], num_classes, num_samples)) is not None:
+        
+        feature = feature[perm]     # (500, num_units), the only copy
+    
+    if meta.get('encoding') == 'spike_count':
+        
+        if counts:
+            normalize = False
+        else:
+            feature = feature.astype(np.float32)
+            if not normalize:
+                feature /= meta['T']     # firing rates
     
     if normalize:     # min-max normalize -> [0,1], not standardize -> N(0,1)
         
-        feature = (feature-np.min(feature))/(np.max(feature)-np.min(feature))     # (500, num_features)
+        if not np.issubdtype(feature.dtype, np.floating):
+            feature = feature.astype(np.float64)
+        
+        if 'min' in meta and 'max' in meta:
+            _min, _max = feature.dtype.type(meta['min']), feature.dtype.type(meta['max'])
+        else:
+            _min, _max = np.min(feature), np.max(feature)
+        
+        feature -= _min
+        feature /= (_max-_min)     # (500, num_features)
     
-    if sort:
+    if _feature_cache.max_bytes > 0:
         
-        feature = restore_order(feature, num_classes, num_samples)     # (50, num_units)
+        _feature_cache.put(key, feature)
     
     return feature
 
 
+# ---
+class Feature_Cache():
+    """
+        process-wide LRU cache of features returned by load_feature(), bounded by a memory budget in bytes and disabled 
+        if max_bytes is 0
+        
+        cached features are read-only and shared by all callers, the key is the source file (path + mtime) and the 
+        normalize/sort flags
+    """
+    
+    def __init__(self, max_bytes=0):
+        
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        
+    
+    def get(self, key):
+        
+        with self._lock:
+            
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            
+            self.misses += 1
+            
+            return None
+        
+    
+    def put(self, key, feature):
+        
+        if feature.nbytes > self.max_bytes:
+            return
+        
+        feature.setflags(write=False)
+        
+        with self._lock:
+            
+            if key in self._cache:
+                self.nbytes -= self._cache.pop(key).nbytes
+            
+            self._cache[key] = feature
+            self.nbytes += feature.nbytes
+            
+            self._evict()
+            
+    
+    def resize(self, max_bytes):
+        
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+            
+    
+    def _evict(self):
+        """ drop the least recently used features until the budget holds, the caller holds the lock """
+        
+        while self._cache and self.nbytes > max(self.max_bytes, 0):
+            _, _feature = self._cache.popitem(last=False)
+            self.nbytes -= _feature.nbytes
+                
+    
+    def clear(self):
+        
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+            
+    
+    def info(self) -> dict:
+        
+        return {'hits': self.hits, 'misses': self.misses, 'num_features': len(self._cache), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+_feature_cache = Feature_Cache()
+
+
+def set_feature_cache(max_bytes=0):
+    """ enable the process-wide feature cache with the given memory budget (bytes), 0 disables it """
+    
+    _feature_cache.resize(max_bytes)
+
+
+def clear_feature_cache():
+    
+    _feature_cache.clear()
+
+
+def feature_cache_info() -> dict:
+    
+    return _feature_cache.info()
+
+
 # ---
 def restore_order(input, num_classes=50, num_samples=10, **kwargs):
     """
         ...
     """
     
-    if input.shape[0] == num_classes:
+    perm = restore_order_permutation(input.shape[0], num_classes, num_samples)
     
-        return input[np.argsort(lexicographic_order(num_classes))]
-    
-    elif input.shape[0] == num_classes*num_samples:
+    if perm is not None:
         
-        return input[np.argsort(lexicographic_order(num_classes, num_samples), kind='stable')]
+        return input[perm]
+
+
+@functools.lru_cache(maxsize=None)
+def restore_order_permutation(num_rows, num_classes=50, num_samples=10):
+    """
+        the permutation from lexicographic order (pytorch ImageFolder) into natural order, cached per 
+        (num_rows, num_classes, num_samples) and read-only, None if num_rows matches neither
+    """
+    
+    if num_rows == num_classes:
+        perm = np.argsort(lexicographic_order(num_classes))
+    elif num_rows == num_classes*num_samples:
+        perm = np.argsort(lexicographic_order(num_classes, num_samples), kind='stable')
+    else:
+        return None
+    
+    perm.setflags(write=False)
+    
+    return perm
 
 
 # -----
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:36:08 2026
+
+@author: acxyle
+
+    worker transport: read-only arrays are saved once per run as .npy files in shared memory (/dev/shm, or the temp
+    dir if not available), the worker tasks receive only the lightweight Shared_Handle and np.memmap it in the task,
+    so the dispatch cost of joblib.Parallel does not grow with the number of tasks
+
+    the memmap is opened per call and not cached in the process, the reused (loky) workers hold no reference to the
+    files once the task returns, so the removed files of a closed run do not stay pinned in shared memory
+
+    e.g.
+        with utils_.Shared_Arrays() as shared:
+            handle = shared.put(array)
+            pl = Parallel(n_jobs=...)(delayed(func)(handle, layer) for layer in layers)
+
+        def func(handle, layer):
+            array = utils_.shared_load(handle)
+
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+__all__ = [
+    'Shared_Arrays', 'Shared_Handle', 'shared_load'
+    ]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class Shared_Handle():
+    """ picklable reference of one shared array """
+
+    def __init__(self, path, shape, dtype, **kwargs):
+
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    def __repr__(self):
+        return f'Shared_Handle({self.path}, shape={self.shape}, dtype={self.dtype})'
+
+
+class Shared_Arrays():
+    """ context manager, owns the shared files of one run and removes them on exit """
+
+    def __init__(self, root=None, prefix='FSA_', **kwargs):
+
+        if root is None:
+            root = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+        self.root = root
+        self.prefix = prefix
+
+        self.path = None
+        self.handles = []
+
+
+    def __enter__(self):
+
+        self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+    def put(self, array):
+        """ ndarray -> Shared_Handle, other objects (None, scalars, lazy Permuted_Stats...) are returned unchanged """
+
+        if not isinstance(array, np.ndarray):
+            return array
+
+        assert self.path is not None, '[Coderror] Shared_Arrays should be used as context manager'
+
+        file_path = os.path.join(self.path, f'{len(self.handles)}.npy')
+        np.save(file_path, np.ascontiguousarray(array))
+
+        handle = Shared_Handle(file_path, array.shape, array.dtype.str)
+        self.handles.append(handle)
+
+        return handle
+
+
+    def close(self):
+
+        if self.path is not None:
+
+            shutil.rmtree(self.path, ignore_errors=True)
+
+            self.path = None
+            self.handles = []
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def shared_load(handle):
+    """ Shared_Handle -> read-only np.memmap (mapping only, released with the array), other objects are returned unchanged """
+
+    if isinstance(handle, Shared_Handle):
+        return np.load(handle.path, mmap_mode='r')
+
+    return handle
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:14:52 2026
+
+@author: acxyle
+
+    spike store: the full binary spike trains of one SNN layer, saved as 'Features/{layer}_spikes/' with one bit-packed
+    .npy chunk per extraction batch + one 'meta.json', the chunk of B samples is (B, ceil(num_units*T/8)) uint8, the bit
+    (unit*T + t) of every row is the spike of that unit at time step t (little bit order)
+
+    firing rates, time windows and unit subsets are decoded chunk by chunk, the dense (T, num_samples, num_units) tensor
+    is never created
+
+    e.g.
+        writer = utils_.Spike_Store_Writer('Features/L5_B2_neuron', T=4, num_units=4096)
+        writer.write(spikes)     # (T, batch_size, num_units), for every batch in order
+        writer.close(num_classes=50)
+
+        store = utils_.Spike_Store('Features/L5_B2_neuron')
+        frs = store.firing_rates(select_ratio=0.5)     # (num_samples, num_units), the last half of time steps
+
+    cumulative counts: 'Features/{layer}_cumulative.npy', (T, num_samples, num_units) uint8, the spike counts of every
+    unit over time steps 0..t, the counts of any time window [t0, t1) are the difference of 2 slices, so only 2 of the T
+    slices are read
+
+"""
+
+import os
+import json
+import numpy as np
+
+
+__all__ = [
+    'Spike_Store_Writer', 'Spike_Store', 'spike_store_path',
+    'Cumulative_Counts', 'open_cumulative_counts', 'cumulative_counts_path'
+    ]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _time_window(T, select_ratio=0, t_range=None) -> tuple:
+    """ [t0, t1), select_ratio: the last int(T*select_ratio) time steps (0 for all), as spikes_to_frs() """
+
+    if t_range is not None:
+        return t_range
+
+    target_T_idx = int(T*select_ratio)
+
+    return (T-target_T_idx, T) if target_T_idx > 0 else (0, T)
+
+
+def spike_store_path(file_path) -> str:
+    """ 'Features/{layer}.pkl' or 'Features/{layer}' -> 'Features/{layer}_spikes' """
+
+    root = os.path.splitext(file_path)[0] if os.path.splitext(file_path)[-1] in ['.pkl', '.pickle', '.npy', '.json'] else file_path
+
+    return root if root.endswith('_spikes') else f'{root}_spikes'
+
+
+class Spike_Store_Writer():
+    """ appends one bit-packed chunk per batch, meta.json is written by close() """
+
+    def __init__(self, file_path, T, num_units, **kwargs):
+
+        self.path = spike_store_path(file_path)
+        os.makedirs(self.path, exist_ok=True)
+
+        for file_name in os.listdir(self.path):     # overwrite
+            if file_name.endswith('.npy') or file_name == 'meta.json':
+                os.remove(os.path.join(self.path, file_name))
+
+        self.T = T
+        self.num_units = num_units
+        self.chunks = []
+
+
+    @property
+    def shape(self):
+        return (self.T, sum(self.chunks), self.num_units)
+
+
+    def write(self, spikes) -> None:
+        """ spikes: (T, batch_size, num_units) binary, ndarray of any dtype """
+
+        spikes = np.asarray(spikes)
+        assert spikes.ndim == 3 and spikes.shape[0] == self.T and spikes.shape[2] == self.num_units, f'expected (T={self.T}, batch_size, {self.num_units}) spikes, got {spikes.shape}'
+
+        packed = np.packbits(spikes.astype(bool).transpose(1, 2, 0).reshape(spikes.shape[1], -1), axis=1, bitorder='little')     # (batch_size, ceil(num_units*T/8))
+
+        np.save(os.path.join(self.path, f'{len(self.chunks):06d}.npy'), packed)
+        self.chunks.append(spikes.shape[1])
+
+
+    def close(self, num_classes=50, num_samples=None, **kwargs) -> dict:
+
+        meta = {
+            'T': self.T,
+            'num_units': self.num_units,
+            'chunks': self.chunks,
+            'num_classes': num_classes,
+            'num_samples': num_samples if num_samples is not None else sum(self.chunks)//num_classes,
+            'order': 'lexicographic',
+            'bitorder': 'little',
+            **kwargs
+            }
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=5)
+
+        return meta
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class Spike_Store():
+    """
+        reader of one layer of the spike store, rows are in the saved (lexicographic) order
+
+        the decoding of the entire layer unpacks at most max_bytes of spikes at once, the decoding of a unit subset
+        only gathers the bytes of those units
+    """
+
+    def __init__(self, file_path, max_bytes=2**26, **kwargs):
+
+        self.path = spike_store_path(file_path)
+
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.T = self.meta['T']
+        self.num_units = self.meta['num_units']
+        self.chunks = self.meta['chunks']
+        self.max_bytes = max_bytes
+
+
+    @property
+    def shape(self):
+        return (self.T, sum(self.chunks), self.num_units)
+
+
+    def __len__(self):
+        return sum(self.chunks)
+
+
+    def _time_window(self, select_ratio=0, t_range=None) -> tuple:
+        return _time_window(self.T, select_ratio, t_range)
+
+
+    def _packed_chunks(self):
+
+        for idx in range(len(self.chunks)):
+            yield np.load(os.path.join(self.path, f'{idx:06d}.npy'), mmap_mode='r')
+
+
+    def _decode(self, packed, t0, t1, units=None) -> np.ndarray:
+        """ (rows, bytes) -> (rows, len(units) or num_units, t1-t0) uint8 """
+
+        if units is None:
+            spikes = np.unpackbits(packed, axis=1, count=self.num_units*self.T, bitorder='little').reshape(packed.shape[0], self.num_units, self.T)
+            return spikes[:, :, t0:t1]
+
+        bits = np.asarray(units)[:, None]*self.T + np.arange(t0, t1)     # (num_units, t1-t0)
+
+        return (packed[:, bits//8] >> (bits%8).astype(np.uint8)) & 1
+
+
+    def _blocks(self, units=None):
+        """ row blocks bounded by max_bytes of decoded spikes """
+
+        num_units = self.num_units if units is None else len(units)
+        block_rows = max(1, self.max_bytes//max(1, num_units*self.T))
+
+        for packed in self._packed_chunks():
+            for start in range(0, packed.shape[0], block_rows):
+                yield np.asarray(packed[start:start+block_rows])
+
+
+    def counts(self, select_ratio=0, t_range=None, units=None, **kwargs) -> np.ndarray:
+        """ (num_samples, num_units) spike counts in the time window, uint8 if they fit (t1-t0 < 256), wider otherwise """
+
+        t0, t1 = self._time_window(select_ratio, t_range)
+
+        return np.concatenate([self._decode(block, t0, t1, units).sum(axis=-1, dtype=np.min_scalar_type(t1-t0)) for block in self._blocks(units)], axis=0)
+
+
+    def firing_rates(self, select_ratio=0, t_range=None, units=None, **kwargs) -> np.ndarray:
+        """ (num_samples, num_units) float32 firing rates in the time window """
+
+        t0, t1 = self._time_window(select_ratio, t_range)
+
+        return self.counts(t_range=(t0, t1), units=units).astype(np.float32)/(t1-t0)
+
+
+    def spikes(self, units=None, select_ratio=0, t_range=None, **kwargs) -> np.ndarray:
+        """ (T', num_samples, len(units)) uint8 spike trains, use units to keep it small """
+
+        t0, t1 = self._time_window(select_ratio, t_range)
+
+        return np.concatenate([self._decode(block, t0, t1, units) for block in self._blocks(units)], axis=0).transpose(2, 0, 1)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def cumulative_counts_path(file_path) -> str:
+    """ 'Features/{layer}.pkl' or 'Features/{layer}' -> 'Features/{layer}_cumulative.npy' """
+
+    root = os.path.splitext(file_path)[0] if os.path.splitext(file_path)[-1] in ['.pkl', '.pickle', '.npy', '.json'] else file_path
+
+    return f'{root}.npy' if root.endswith('_cumulative') else f'{root}_cumulative.npy'
+
+
+def open_cumulative_counts(file_path, T, num_samples, num_units, **kwargs) -> np.memmap:
+    """ writable (T, num_samples, num_units) uint8 np.memmap, filled batch by batch with cumsum(spikes, dim=0) """
+
+    assert T < 256, f'T={T} does not fit into uint8 counts'
+
+    return np.lib.format.open_memmap(cumulative_counts_path(file_path), mode='w+', dtype=np.uint8, shape=(T, num_samples, num_units))
+
+
+class Cumulative_Counts():
+    """ reader of the cumulative counts of one layer, same interface as Spike_Store for counts and firing rates """
+
+    def __init__(self, file_path, **kwargs):
+
+        self.path = cumulative_counts_path(file_path)
+        self.data = np.load(self.path, mmap_mode='r')     # (T, num_samples, num_units)
+
+        self.T = self.data.shape[0]
+
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
+    def __len__(self):
+        return self.data.shape[1]
+
+
+    def counts(self, select_ratio=0, t_range=None, units=None, **kwargs) -> np.ndarray:
+        """ (num_samples, num_units) uint8 spike counts in the time window [t0, t1) """
+
+        t0, t1 = _time_window(self.T, select_ratio, t_range)
+        cols = slice(None) if units is None else units
+
+        counts = np.array(self.data[t1-1][:, cols])
+
+        if t0 > 0:
+            counts -= self.data[t0-1][:, cols]
+
+        return counts
+
+
+    def firing_rates(self, select_ratio=0, t_range=None, units=None, **kwargs) -> np.ndarray:
+        """ (num_samples, num_units) float32 firing rates in the time window [t0, t1) """
+
+        t0, t1 = _time_window(self.T, select_ratio, t_range)
+
+        return self.counts(t_range=(t0, t1), units=units).astype(np.float32)/(t1-t0)
@@ -16,7 +16,9 @@ import numpy as np
 
 from sklearn import svm
 from sklearn.metrics import accuracy_score
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, StratifiedKFold
+
+from joblib import Parallel, delayed
 
 import torch
 
@@ -27,14 +29,25 @@ from spikingjelly.activation_based.model.tv_ref_classify import utils
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-#TODO ----- need to find a solution to save small pieces and merge them into one single feature map
 def spikes_to_frs(feature, select_ratio=0, **kwargs):
     """
         in this function, the feature is compressed by sipikingjelly module
         if zlib is used, the compressed file may greater than the original one when the data is diverse
         
         refer to: https://spikingjelly.readthedocs.io/zh-cn/latest/activation_based_en/ann2snn.html
+        
+        feature: also accepts the path of one layer, or its utils_.Cumulative_Counts (2 slices are read) or its 
+                 utils_.Spike_Store (decoded chunk by chunk), the cumulative counts are used if both exist
     """
+    
+    from ._spike_store import Spike_Store, Cumulative_Counts, cumulative_counts_path
+    
+    if isinstance(feature, str):
+        feature = Cumulative_Counts(feature) if os.path.exists(cumulative_counts_path(feature)) else Spike_Store(feature)
+    
+    if isinstance(feature, (Spike_Store, Cumulative_Counts)):
+        return feature.firing_rates(select_ratio=select_ratio)
+    
     assert feature[0][0].dtype==torch.uint8, "the data must be compressed 'bool spikes'."
 
     target_T_idx = int(feature[0][2][1]*select_ratio)
@@ -88,6 +101,22 @@ def formatted_print(content, message_type='[Codinfo]', symbol='-', padding=2, bo
 
 
 # -----
+_num_workers = None
+
+
+def set_num_workers(num_workers=None):
+    """ process-wide number of joblib workers used by the analyzers, None restores the default of each analyzer """
+    
+    global _num_workers
+    
+    _num_workers = num_workers
+    
+    
+def get_num_workers(default=1):
+    
+    return default if _num_workers is None else _num_workers
+
+
 def make_dir(path):
   if not os.path.exists(path):
     os.makedirs(path, exist_ok=True)
@@ -98,11 +127,11 @@ def cal_acc1_acc5(output, target):
     return acc1, acc5
     
 # ----- SVM
-# FIXME --- add k-fold entrance
-def SVM_classification(matrix, label, test_size=0.2, random_state=42):
+def SVM_classification(matrix, label, test_size=0.2, random_state=42, num_folds=None, kernel='rbf', **kwargs):
     """
         1. default kernel='rbf', non-linear. 
-        2. train_test_split() splits train data and test data randomly, not like n_fold experiments
+        2. train_test_split() splits train data and test data randomly, not like n_fold experiments, unless num_folds is 
+           given: stratified k-fold, mean accuracy of all folds, see SVM_classification_Gram()
         
         "It should be noticed the performance of svm.SVC() can be highly sensitive 
         to the choice of kernel, used what kernel depends on the data and the 
@@ -111,6 +140,12 @@ def SVM_classification(matrix, label, test_size=0.2, random_state=42):
         consuming and computation intensive."
     """
     
+    if num_folds is not None or kernel != 'rbf':
+        
+        matrix = np.asarray(matrix, dtype=np.float64)
+        
+        return SVM_classification_Gram(matrix @ matrix.T, matrix.sum(axis=1), matrix.shape[1], label, test_size=test_size, random_state=random_state, num_folds=num_folds, kernel=kernel, **kwargs)
+    
     matrix_train, matrix_test, label_train, label_test = train_test_split(matrix, label, test_size=test_size, random_state=random_state)
 
     clf = svm.SVC()     # .SVC() .LinearSVC() .NuSVC() ... 
@@ -125,6 +160,117 @@ def SVM_classification(matrix, label, test_size=0.2, random_state=42):
     return acc
 
 
+def SVM_classification_Gram(gram, row_sum, num_features, label, test_size=0.2, random_state=42, num_folds=None, kernel='rbf', n_jobs=None, **kwargs):
+    """
+        the same as SVM_classification() from the additive statistics of the matrix: gram = matrix.dot(matrix.T), 
+        row_sum = matrix.sum(1), num_features = matrix.shape[1], the fit cost does not depend on num_features
+        
+        the squared distances are derived once, every split builds its precomputed kernel from them:
+            kernel='rbf': gamma='scale' of the training samples, the same as svm.SVC()
+            kernel='linear': the gram itself
+        
+        num_folds: None - one train_test_split() with test_size, int - StratifiedKFold, folds run in parallel threads
+    """
+    
+    if num_features == 0:
+        return 0.
+    
+    if kernel not in ['rbf', 'linear']:
+        raise ValueError(f'[Coderror] invalid kernel {kernel}')
+    
+    label = np.asarray(label)
+    sq_norms = np.diag(gram)
+    
+    sq_distances = np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2*gram, 0) if kernel == 'rbf' else None
+    
+    if num_folds is None:
+        splits = [train_test_split(np.arange(len(label)), test_size=test_size, random_state=random_state)]
+    else:
+        splits = list(StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=random_state).split(np.zeros((len(label), 1)), label))
+    
+    if len(splits) == 1:
+        acc = [_SVM_classification_split(gram, sq_norms, row_sum, sq_distances, num_features, label, *splits[0], kernel)]
+    else:
+        acc = Parallel(n_jobs=get_num_workers(len(splits)) if n_jobs is None else n_jobs, prefer='threads')(delayed(_SVM_classification_split)(gram, sq_norms, row_sum, sq_distances, num_features, label, idx_train, idx_test, kernel) for idx_train, idx_test in splits)
+    
+    return np.mean(acc)
+
+
+def _SVM_classification_split(gram, sq_norms, row_sum, sq_distances, num_features, label, idx_train, idx_test, kernel='rbf'):
+    
+    if kernel == 'rbf':
+        
+        # --- gamma='scale': 1/(num_features*matrix_train.var())
+        num_values = idx_train.size*num_features
+        matrix_var = np.sum(sq_norms[idx_train])/num_values - (np.sum(row_sum[idx_train])/num_values)**2
+        
+        gamma = 1.0/(num_features*matrix_var) if matrix_var != 0 else 1.0
+        
+        kernel_train = np.exp(-gamma*sq_distances[np.ix_(idx_train, idx_train)])
+        kernel_test = np.exp(-gamma*sq_distances[np.ix_(idx_test, idx_train)])
+        
+    elif kernel == 'linear':
+        
+        kernel_train = gram[np.ix_(idx_train, idx_train)]
+        kernel_test = gram[np.ix_(idx_test, idx_train)]
+    
+    clf = svm.SVC(kernel='precomputed')
+    
+    clf.fit(kernel_train, label[idx_train])
+    predicted = clf.predict(kernel_test)
+    acc = accuracy_score(label[idx_test], predicted)*100
+    
+    return acc
+
+
+def ridge_classification_Gram(gram, label, alphas=(1e-3, 1e-2, 1e-1, 1., 10.), num_folds=5, random_state=42, **kwargs) -> np.ndarray:
+    """
+        linear kernel ridge classifier (one-vs-all ±1 targets, no intercept) solved in dual form on the 
+        (num_samples, num_samples) sample Gram, StratifiedKFold accuracy (%) of every regularization value
+        
+        one eigendecomposition K = Q·diag(λ)·Qᵀ serves all alphas and all folds: with A = (K+alpha·I)⁻¹, the held-out 
+        residuals of fold F are exactly A_FF⁻¹·(A·Y)_F, so no fold is refitted
+        
+        alphas: relative to the mean eigenvalue trace(K)/num_samples, so the values do not depend on the feature scale
+        return: (num_alphas,)
+    """
+    
+    label = np.asarray(label)
+    
+    if np.trace(gram) == 0:     # empty or all zero feature
+        return np.zeros(len(alphas))
+    
+    classes, label_idx = np.unique(label, return_inverse=True)
+    Y = -np.ones((label.size, classes.size))
+    Y[np.arange(label.size), label_idx] = 1.
+    
+    eigenvalues, Q = np.linalg.eigh(gram)
+    eigenvalues = np.maximum(eigenvalues, 0)
+    QtY = Q.T @ Y
+    
+    splits = [idx_test for _, idx_test in StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=random_state).split(np.zeros((label.size, 1)), label)]
+    
+    acc = np.zeros(len(alphas))
+    
+    for alpha_idx, alpha in enumerate(alphas):
+        
+        inv_eigenvalues = 1./(eigenvalues + alpha*np.mean(eigenvalues))
+        AY = Q @ (inv_eigenvalues[:, None]*QtY)
+        
+        num_correct = 0
+        
+        for idx_test in splits:
+            
+            A_FF = (Q[idx_test]*inv_eigenvalues) @ Q[idx_test].T
+            predicted = Y[idx_test] - np.linalg.solve(A_FF, AY[idx_test])     # held-out predictions
+            
+            num_correct += np.sum(np.argmax(predicted, axis=1) == label_idx[idx_test])
+        
+        acc[alpha_idx] = num_correct/label.size*100
+    
+    return acc
+
+
 def makeLabels(num_samples, num_classes):  # generate a label list
     label = []
     for i in range(num_classes):
@@ -18,8 +18,6 @@ from matplotlib.lines import Line2D
 from scipy.spatial.distance import pdist, squareform
 
 from scipy.stats import pearsonr, spearmanr, kendalltau, ttest_ind
-import itertools
-from scipy.spatial.distance import mahalanobis
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -80,11 +78,11 @@ def DSM_calculation(feature, metric='pearson', vectorize=False, num_calsses=50,
             return np.zeros((num_calsses, num_calsses))
             #raise ValueError
    
-    elif 'spearman':
+    elif 'spearman' in metric.lower():
         
         return RSM_process(spearmanr(feature, axis=1, nan_policy='omit').statistic, vectorize)
     
-    elif 'mahalanobis':
+    elif 'mahalanobis' in metric.lower():
         
         if (mask:=_size_and_mask_check(feature)) is not None:
             
@@ -95,20 +93,11 @@ def DSM_calculation(feature, metric='pearson', vectorize=False, num_calsses=50,
         else:
             raise ValueError
         
-    elif 'concordance':
+    elif 'concordance' in metric.lower():
         
         if (mask:=_size_and_mask_check(feature)) is not None:
             
-            feature = feature[:, mask]
-            
-            num_sampels = feature.shape[0]
-            
-            product_list = list(itertools.product(np.arange(num_sampels),np.arange(num_sampels)))
-            
-            ccc_matrix = np.full((num_sampels, num_sampels), np.nan)
-            
-            for _ in product_list:
-                ccc_matrix[_[0], _[1]] = _ccc(feature[_[0]], feature[_[1]])
+            ccc_matrix = _ccc_matrix(feature[:, mask])
             
             return RSM_process(ccc_matrix, vectorize, 'standardization')
         
@@ -119,6 +108,31 @@ def DSM_calculation(feature, metric='pearson', vectorize=False, num_calsses=50,
         raise ValueError
     
 
+def DSM_pearson_from_moments(num_units, row_sum, dot_products, vectorize=False, num_calsses=50, **kwargs):
+    """
+        the same as DSM_calculation(feature, 'pearson') of a NaN-free (num_classes, num_units) feature from its 
+        streaming moments, num_units, row_sum = feature.sum(1) and dot_products = feature·featureᵀ
+    """
+    
+    if num_units == 0:
+        return np.zeros((num_calsses, num_calsses))
+    
+    mean = row_sum / num_units
+    cov = dot_products / num_units - np.outer(mean, mean)     # population covariance, the scale cancels in corrcoef
+    
+    # --- constant rows (e.g. an all-zero class mean), the rounding residual of the moments is not a variance
+    std = np.sqrt(np.clip(np.diag(cov), 0., None))
+    constant = np.diag(cov) <= 1e-12 * np.maximum(np.diag(dot_products) / num_units, np.finfo(np.float64).tiny)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.clip(cov / np.outer(std, std), -1., 1.)
+    
+    similarity[constant, :] = 0.     # the same as np.ma.corrcoef(), masked correlations of a constant row are 0
+    similarity[:, constant] = 0.
+    
+    return RSM_process(similarity, vectorize, 'arctanh')
+
+
 def RSM_process(RSM:np.ndarray, vectorize:bool=False, post_process:bool=None, **kwargs):
     """
         ...
@@ -172,21 +186,44 @@ def RSM_vectorize(RSM:np.ndarray, k=1, m=None):
     return RSM[np.triu_indices(RSM.shape[0], k, m)]
 
 
-def _mahalanobis(input):
+def _mahalanobis(input, eps=1e-8):
+    """
+        pairwise mahalanobis distances of the samples with the inverse of np.cov(input, rowvar=False) + eps*I
+        
+        the (num_features, num_features) covariance is never built: with the thin SVD of the centered input 
+        U·S·Vᵀ/sqrt(num_samples-1), all pairwise differences lie in the span of V, so the whitened samples are 
+        Z = sqrt(num_samples-1)·U·S/sqrt(S²+eps) and the distances are the euclidean distances of Z, also for 
+        num_features ≫ num_samples
+    """
     
-    (num_sampels, num_features) = input.shape
+    num_sampels = input.shape[0]
     
-    product_list = list(itertools.product(np.arange(num_sampels),np.arange(num_sampels)))
+    input = np.asarray(input, dtype=np.float64)
     
-    cm = np.cov(input, rowvar=False) + np.eye(num_features)*1e-8
-    icm = np.linalg.inv(cm)
+    U, S, _ = np.linalg.svd((input - input.mean(axis=0))/np.sqrt(num_sampels-1), full_matrices=False)
     
-    mahal_matrix = np.full((num_sampels, num_sampels), np.nan)
+    Z = np.sqrt(num_sampels-1)*U*(S/np.sqrt(S**2+eps))     # (num_samples, rank)
     
-    for _ in product_list:
-        mahal_matrix[_[0], _[1]] = mahalanobis(input[_[0]], input[_[1]], icm)
+    return squareform(pdist(Z, 'euclidean'))
+
+
+def _ccc_matrix(input):
+    """ pairwise _ccc() of the samples (rows), with population means, variances and covariances """
+    
+    input = np.asarray(input, dtype=np.float64)
+    
+    means = input.mean(axis=1)
+    centered = input - means[:, None]
     
-    return mahal_matrix
+    cov = centered @ centered.T / input.shape[1]
+    var = np.diag(cov).copy()
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ccc_matrix = 2 * cov / (var[:, None] + var[None, :] + (means[:, None] - means[None, :])**2)
+    
+    ccc_matrix[(var[:, None] == 0) | (var[None, :] == 0)] = np.nan     # the same as np.corrcoef() of a constant vector
+    
+    return ccc_matrix
 
 
 def _size_and_mask_check(input):
@@ -210,7 +247,12 @@ def gram_linear(x, **kwargs):
 
 def gram_rbf(x, threshold=1.0, **kwargs):
 
-    dot_products = x.dot(x.T)
+    return gram_rbf_from_linear(x.dot(x.T), threshold)
+
+
+def gram_rbf_from_linear(dot_products, threshold=1.0, **kwargs):
+    """ rbf Gram from the linear Gram x·xᵀ, the rbf kernel only needs the dot products """
+    
     sq_norms = np.diag(dot_products)
     sq_distances = -2 * dot_products + sq_norms[:, None] + sq_norms[None, :]
     sq_median_distance = np.median(sq_distances)
@@ -271,6 +313,103 @@ def cka_temporal(primate_Gram_temporal, NN_Gram, **kwargs):
     return np.array([cka(_, NN_Gram, **kwargs) for _ in primate_Gram_temporal])      # (time_steps, )
 
 
+def center_gram_batch(grams, unbiased=True):
+    """ center_gram() of every (n, n) matrix of the (..., n, n) stack, without the symmetric check """
+
+    grams = np.array(grams, copy=True)
+    
+    n = grams.shape[-1]
+    diag = np.arange(n)
+    
+    if unbiased:
+        
+        grams[..., diag, diag] = 0
+        means = np.sum(grams, -2, dtype=np.float64) / (n - 2)
+        means -= np.sum(means, -1, keepdims=True) / (2 * (n - 1))
+        grams -= means[..., :, None]
+        grams -= means[..., None, :]
+        grams[..., diag, diag] = 0
+    else:
+        
+        means = np.mean(grams, -2, dtype=np.float64)
+        means -= np.mean(means, -1, keepdims=True) / 2
+        grams -= means[..., :, None]
+        grams -= means[..., None, :]
+    
+    return grams
+
+
+def cka_batch(primate_Grams, NN_Gram, debiased=True, chunk_size=64, **kwargs):
+    """
+        cka() of every primate Gram against the same NN Gram, the NN Gram is checked and centered once per call and the 
+        HSIC of every chunk of primate Grams is one einsum
+        
+        input shape: Bio - (..., n, n), e.g. (n, n), (time_steps, n, n), (num_perm, n, n), (num_perm, time_steps, n, n), or 
+                     a lazy Permuted_Stats, whose stats are centered once and gathered per chunk (centering commutes with 
+                     the permutation); NN - (n, n)
+        return: (...), the same values as cka() of every matrix
+    """
+    
+    batch_shape = tuple(primate_Grams.shape[:-2])
+    
+    if NN_Gram.size == 1 and NN_Gram == 0:     # if feature is empty
+        return np.full(batch_shape, np.nan)
+    
+    if not np.allclose(NN_Gram, NN_Gram.T, rtol=1e-06, atol=1e-05):
+        raise ValueError('Input must be a symmetric matrix.')
+    
+    NN_Gram = center_gram_batch(NN_Gram, unbiased=debiased)
+    normalization_y = np.linalg.norm(NN_Gram)
+    
+    # ---
+    def _symmetric_check(grams):
+        if not np.allclose(grams, np.swapaxes(grams, -1, -2), rtol=1e-06, atol=1e-05):
+            raise ValueError('Input must be a symmetric matrix.')
+    
+    if hasattr(primate_Grams, 'perm_indices'):     # lazy Permuted_Stats
+        
+        _symmetric_check(primate_Grams.stats)
+        stats = center_gram_batch(primate_Grams.stats, unbiased=debiased)     # ((time_steps,) n, n)
+        
+        def _chunk(start):
+            P = primate_Grams.perm_indices[start:start+chunk_size]
+            return np.moveaxis(stats[..., P[:, :, None], P[:, None, :]], -3, 0)     # (chunk, (time_steps,) n, n)
+        
+        num_grams = batch_shape[0]
+        
+    else:
+        
+        primate_Grams = np.asarray(primate_Grams).reshape(-1, *primate_Grams.shape[-2:])
+        
+        def _chunk(start):
+            grams = primate_Grams[start:start+chunk_size]
+            _symmetric_check(grams)
+            return center_gram_batch(grams, unbiased=debiased)
+        
+        num_grams = primate_Grams.shape[0]
+    
+    scaled_hsic, normalization_x = [], []
+    
+    for start in range(0, num_grams, chunk_size):
+        
+        grams = _chunk(start)
+        
+        scaled_hsic.append(np.einsum('...ij,ij->...', grams, NN_Gram))
+        normalization_x.append(np.sqrt(np.einsum('...ij,...ij->...', grams, grams)))
+    
+    scaled_hsic = np.concatenate(scaled_hsic).reshape(batch_shape) if scaled_hsic else np.empty(batch_shape)
+    normalization_x = np.concatenate(normalization_x).reshape(batch_shape) if normalization_x else np.empty(batch_shape)
+    
+    # --- the same rules as cka(): nan for all zero feature, clamped to [0, 1] otherwise (nan score -> 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cka_score = scaled_hsic / (normalization_x * normalization_y)
+    
+    cka_score = np.where(cka_score > 0., np.minimum(1., cka_score), 0.)
+    cka_score[(normalization_x == 0) | (normalization_y == 0)] = np.nan
+    
+    return cka_score
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def describe_numpy(input:np.array=None):
     """